@@ -1,10 +1,40 @@
 import os
-import itertools
+import sys
 import math
-from flask import Flask, render_template, request, jsonify
-from flask_wtf.csrf import CSRFProtect
+import functools
+import threading
+import atexit
+import sqlite3
+import random
+import time
+import bisect
+import hashlib
+import io
+import csv
+import zlib
+import itertools
+import json
+import re
+import shutil
+from array import array
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timedelta, timezone
+import click
+from flask import Flask, Response, render_template, request, jsonify, make_response, g, has_request_context
+from flask import has_app_context
+from flask import stream_with_context
+from flask import before_render_template, template_rendered
+from flask.json.provider import DefaultJSONProvider
+from markupsafe import Markup
+from flask_wtf.csrf import CSRFProtect, generate_csrf
 from flask_limiter import Limiter
 from flask_sqlalchemy import SQLAlchemy # SQLAlchemyをインポート
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy import event
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.exc import OperationalError, ProgrammingError
+from sqlalchemy.pool import NullPool, Pool
 
 app = Flask(__name__)
 
@@ -26,8 +56,473 @@ else:
 app.config['SQLALCHEMY_DATABASE_URI'] = db_url
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+# 接続プールの設定
+# 'default': 通常のプール + pre-ping / 'small': 小さなプール + pre-ping + recycle
+# 'serverless': プールせず毎回接続 (NullPool) / 'pgbouncer': NullPool + PgBouncerのトランザクションプーリング向け
+# Vercel上では既定で 'serverless' を使う
+app.config['DB_POOL_PROFILE'] = os.environ.get('DB_POOL_PROFILE', 'serverless' if os.environ.get('VERCEL') else 'default')
+app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 2))
+app.config['DB_MAX_OVERFLOW'] = int(os.environ.get('DB_MAX_OVERFLOW', 2))
+app.config['DB_POOL_TIMEOUT'] = int(os.environ.get('DB_POOL_TIMEOUT', 5))
+app.config['DB_POOL_RECYCLE'] = int(os.environ.get('DB_POOL_RECYCLE', 300))
+app.config['DB_CONNECT_TIMEOUT'] = int(os.environ.get('DB_CONNECT_TIMEOUT', 5))
+app.config['DB_STATEMENT_TIMEOUT_MS'] = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 5000))
+# 接続の取得にこれ以上かかったらログに残す
+app.config['DB_SLOW_CHECKOUT_MS'] = int(os.environ.get('DB_SLOW_CHECKOUT_MS', 200))
+
+
+# --- DB接続の計測 ---
+# 新しい接続の確立にかかった時間と、プールから接続を取得するまでの待ち時間を集計する
+db_pool_stats = {
+    'connects': 0,
+    'connect_seconds_total': 0.0,
+    'connect_seconds_max': 0.0,
+    'checkouts': 0,
+    'checkout_seconds_total': 0.0,
+    'checkout_seconds_max': 0.0,
+    'checkout_errors': 0,
+    'invalidations': 0,
+}
+db_pool_stats_lock = threading.Lock()
+
+
+def record_pool_timing(kind, seconds):
+    with db_pool_stats_lock:
+        db_pool_stats[f'{kind}s'] += 1
+        db_pool_stats[f'{kind}_seconds_total'] += seconds
+        db_pool_stats[f'{kind}_seconds_max'] = max(db_pool_stats[f'{kind}_seconds_max'], seconds)
+
+
+class TimedPool(Pool):
+    # プールには取得開始のイベントがないので、待ち時間 (新規接続を含む) は connect を上書きして測る。
+    # インスタンスではなくクラスで上書きするので、dispose() でプールが作り直されても計測は続く
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            connection = super().connect()
+        except Exception:
+            with db_pool_stats_lock:
+                db_pool_stats['checkout_errors'] += 1
+            raise
+        elapsed = time.perf_counter() - started
+        record_pool_timing('checkout', elapsed)
+        if elapsed > app.config['DB_SLOW_CHECKOUT_MS'] / 1000:
+            app.logger.warning("Slow database connection checkout: %.1f ms (%s)", elapsed * 1000, self.status())
+        return connection
+
+
+@functools.lru_cache(maxsize=None)
+def timed_pool_class(pool_class):
+    return type(f'Timed{pool_class.__name__}', (TimedPool, pool_class), {})
+
+
+@event.listens_for(Engine, 'do_connect')
+def start_connect_timer(dialect, connection_record, cargs, cparams):
+    connection_record.info['connect_started'] = time.perf_counter()
+
+
+@event.listens_for(TimedPool, 'connect')
+def stop_connect_timer(dbapi_connection, connection_record):
+    started = connection_record.info.pop('connect_started', None)
+    if started is not None:
+        record_pool_timing('connect', time.perf_counter() - started)
+
+
+@event.listens_for(TimedPool, 'invalidate')
+def count_invalidation(dbapi_connection, connection_record, exception):
+    with db_pool_stats_lock:
+        db_pool_stats['invalidations'] += 1
+
+
+@event.listens_for(Engine, 'begin')
+def set_statement_timeout(connection):
+    # PgBouncerのトランザクションプーリングでは接続時のオプションが使えないので、トランザクションごとに設定する
+    if app.config['DB_POOL_PROFILE'] == 'pgbouncer' and app.config['DB_STATEMENT_TIMEOUT_MS'] \
+            and connection.dialect.name == 'postgresql' and isinstance(connection.engine.pool, TimedPool):
+        connection.exec_driver_sql(f"SET LOCAL statement_timeout = {app.config['DB_STATEMENT_TIMEOUT_MS']}")
+
+
+def engine_options(profile, url):
+    options = {}
+    if profile in ('serverless', 'pgbouncer'):
+        options['poolclass'] = timed_pool_class(NullPool)
+    else:
+        # ドライバの既定のプール (SQLiteのファイル/PostgreSQLでは QueuePool) に計測を加える
+        parsed_url = make_url(url)
+        options['poolclass'] = timed_pool_class(parsed_url.get_dialect().get_pool_class(parsed_url))
+        if profile == 'small':
+            options.update(
+                pool_size=app.config['DB_POOL_SIZE'],
+                max_overflow=app.config['DB_MAX_OVERFLOW'],
+                pool_timeout=app.config['DB_POOL_TIMEOUT'],
+                pool_recycle=app.config['DB_POOL_RECYCLE'],
+                pool_pre_ping=True,
+            )
+        else:
+            options['pool_pre_ping'] = True
+
+    if url.startswith('postgresql'):
+        connect_args = {'connect_timeout': app.config['DB_CONNECT_TIMEOUT']}
+        # PgBouncerのトランザクションプーリングでは接続時のオプションを渡せないので、
+        # その場合はトランザクションごとに SET LOCAL で設定する (set_statement_timeout を参照)
+        if profile != 'pgbouncer' and app.config['DB_STATEMENT_TIMEOUT_MS']:
+            connect_args['options'] = f"-c statement_timeout={app.config['DB_STATEMENT_TIMEOUT_MS']}"
+        options['connect_args'] = connect_args
+    return options
+
+
+# エンジンは作成時には接続せず、最初のクエリで接続する
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['DB_POOL_PROFILE'], db_url)
+
+# --- 投票回数の上限 ---
+# 1分あたりの上限 (Flask-Limiter) のカウンタの保存先。サーバーレスの複数インスタンスで共有するには
+# redis:// などの共有ストアを指定する (既定はプロセスごとのメモリ)
+app.config['RATELIMIT_STORAGE_URI'] = os.environ.get('RATELIMIT_STORAGE_URI', 'memory://')
+# 1日の投票数をサーバー側でも数える。カウンタは既定ではメインのDBに置き、
+# QUOTA_DATABASE_URL を指定すると別のDB (ローカルでは sqlite:///vote_quota.db など) に置く
+# 前日以前の行は flask prune-vote-quota で削除する
+app.config['VOTE_QUOTA_ENABLED'] = os.environ.get('VOTE_QUOTA_ENABLED', '1') == '1'
+app.config['QUOTA_DATABASE_URL'] = os.environ.get('QUOTA_DATABASE_URL', '')
+if app.config['QUOTA_DATABASE_URL']:
+    app.config['SQLALCHEMY_BINDS'] = {'quota': app.config['QUOTA_DATABASE_URL']}
+# 日付の切り替わりの基準 (既定は日本時間)
+app.config['VOTE_QUOTA_UTC_OFFSET_HOURS'] = int(os.environ.get('VOTE_QUOTA_UTC_OFFSET_HOURS', 9))
+# 共有ストアに問い合わせる前に、プロセス内のトークンバケットで連打を弾く
+app.config['VOTE_BURST'] = int(os.environ.get('VOTE_BURST', 10))
+app.config['VOTE_REFILL_PER_SECOND'] = float(os.environ.get('VOTE_REFILL_PER_SECOND', 0.5))
+
+# 一覧ページの絞り込み・並べ替え・ページ分けを行う場所
+# 'memory': 起動時に構築したカタログインデックスを使う / 'sql': kitsテーブルと結合してDB側で行う
+app.config['GRID_QUERY_MODE'] = os.environ.get('GRID_QUERY_MODE', 'memory')
+
+# 投票の書き込み方法
+# 'direct': 1票ごとにアトミックなUPDATEでコミット / 'buffered': メモリ上で集約してまとめて書き込む
+app.config['VOTE_WRITE_MODE'] = os.environ.get('VOTE_WRITE_MODE', 'direct')
+# 1日に投票できる回数 (vote.js の MAX_VOTES_PER_DAY と合わせる)
+app.config['MAX_VOTES_PER_DAY'] = int(os.environ.get('MAX_VOTES_PER_DAY', 10))
+app.config['VOTE_BUFFER_FLUSH_MS'] = int(os.environ.get('VOTE_BUFFER_FLUSH_MS', 500))
+app.config['VOTE_BUFFER_MAX_PENDING'] = int(os.environ.get('VOTE_BUFFER_MAX_PENDING', 100))
+# 設定するとバッファ中の票をローカルのSQLiteファイルにも記録し、再起動時に書き戻す
+# (プロセスごとに path, path.1, ... を使い分ける。書き込み直後に落ちると票が重複することがある)
+app.config['VOTE_BUFFER_JOURNAL'] = os.environ.get('VOTE_BUFFER_JOURNAL', '')
+
+# 投票数の保存方法
+# 'single': votesテーブルの1行に加算 / 'sharded': キットごとにK行のシャードへ分散して加算し、定期的にvotesへ集約
+app.config['VOTE_STORAGE'] = os.environ.get('VOTE_STORAGE', 'single')
+app.config['VOTE_SHARD_COUNT'] = int(os.environ.get('VOTE_SHARD_COUNT', 8))
+# シャードをvotesへ集約する間隔 (秒)。0ならCLI (flask compact-shards) からのみ実行
+app.config['VOTE_SHARD_COMPACT_INTERVAL'] = int(os.environ.get('VOTE_SHARD_COMPACT_INTERVAL', 60))
+
+# ランキングの取得方法
+# 'memory': メモリ上のソート済み構造を投票ごとに更新し、TTLごとにDBから再読み込み / 'sql': 毎回DBで並べ替え
+app.config['RANKING_MODE'] = os.environ.get('RANKING_MODE', 'memory')
+app.config['RANKING_CACHE_TTL'] = int(os.environ.get('RANKING_CACHE_TTL', 30))
+
+# 投票の履歴 (分/時間ごとの集計) とトレンド順 (sort=trending)
+app.config['VOTE_HISTORY_ENABLED'] = os.environ.get('VOTE_HISTORY_ENABLED', '1') == '1'
+# 履歴はメモリ上で集約してこの間隔 (秒) でまとめて書き込む。0なら投票と同じトランザクションで書き込む
+# Vercel上ではインスタンスが停止するとバックグラウンドの書き込みが動かないので、既定で 0 にする
+# (0 のときは古いバケットの削除も行わないので、flask prune-vote-history を定期的に実行する)
+app.config['VOTE_HISTORY_FLUSH_SECONDS'] = int(os.environ.get('VOTE_HISTORY_FLUSH_SECONDS', 0 if os.environ.get('VERCEL') else 10))
+# 分ごとの集計は短期間だけ残し、それより前は時間ごとの集計だけを残す
+app.config['VOTE_HISTORY_MINUTE_RETENTION_HOURS'] = max(2, int(os.environ.get('VOTE_HISTORY_MINUTE_RETENTION_HOURS', 48)))
+app.config['VOTE_HISTORY_HOUR_RETENTION_DAYS'] = int(os.environ.get('VOTE_HISTORY_HOUR_RETENTION_DAYS', 30))
+# トレンドのスコアが半分になるまでの時間と、DBの履歴から読み直す間隔 (秒)
+app.config['TRENDING_HALF_LIFE_HOURS'] = float(os.environ.get('TRENDING_HALF_LIFE_HOURS', 6))
+app.config['TRENDING_REFRESH_SECONDS'] = int(os.environ.get('TRENDING_REFRESH_SECONDS', 60))
+
+# 集計API (/api/stats) の投票数ベクトルをDBから読み直す間隔 (秒)。その間は投票ごとに差分で更新する
+app.config['STATS_REFRESH_SECONDS'] = int(os.environ.get('STATS_REFRESH_SECONDS', 60))
+
+# 一覧ページ/ランキングAPIのレスポンスキャッシュ (0でプロセス内キャッシュを無効化)
+app.config['RESPONSE_CACHE_TTL'] = int(os.environ.get('RESPONSE_CACHE_TTL', 5))
+app.config['RESPONSE_CACHE_SIZE'] = int(os.environ.get('RESPONSE_CACHE_SIZE', 256))
+# Vercelのエッジでキャッシュさせる時間 (Cache-Control の s-maxage / stale-while-revalidate)
+app.config['CDN_CACHE_MAX_AGE'] = int(os.environ.get('CDN_CACHE_MAX_AGE', 10))
+app.config['CDN_STALE_WHILE_REVALIDATE'] = int(os.environ.get('CDN_STALE_WHILE_REVALIDATE', 60))
+
+# 投票数の差分配信 (/api/vote_deltas, /api/ranking_stream)
+app.config['VOTE_CHANGE_LOG_SIZE'] = int(os.environ.get('VOTE_CHANGE_LOG_SIZE', 10000))
+# /api/vote_deltas?wait= のロングポーリングの最大秒数 (待つ間ワーカーを占有するので RANKING_STREAM_ENABLED のときだけ)
+app.config['VOTE_DELTA_MAX_WAIT'] = int(os.environ.get('VOTE_DELTA_MAX_WAIT', 25))
+app.config['VOTE_DELTA_MAX_IDS'] = int(os.environ.get('VOTE_DELTA_MAX_IDS', 200))
+app.config['VOTE_STREAM_MAX_SECONDS'] = int(os.environ.get('VOTE_STREAM_MAX_SECONDS', 55))
+# ランキングページで /api/ranking_stream (SSE) を使う。変更履歴はプロセスごとで、接続中はワーカーを1つ占有するので、
+# 常駐する単一プロセスのサーバー向け。無効なら /api/vote_deltas をポーリングする
+app.config['RANKING_STREAM_ENABLED'] = os.environ.get('RANKING_STREAM_ENABLED', '0') == '1'
+# 描画済みのタイルを保持するキット数。有効なキット (約17,000件) より少なくし、よく表示されるものだけ残す
+app.config['TILE_CACHE_SIZE'] = int(os.environ.get('TILE_CACHE_SIZE', 4096))
+
+# --- 静的ファイル ---
+# flask build-assets を実行すると、static/dist にハッシュ付きのファイル名でコピーした静的ファイルと
+# manifest.json を作る (static/dist がなければ元のファイルをそのまま使う)。ファイル名は内容が変われば変わるので、長期間キャッシュさせる
+# Vercel (vercel.json の builds 設定) ではビルドコマンドが実行されないので、static/dist はリポジトリにコミットする。
+# static 以下を変更したらビルドし直してコミットする (tests/test_assets.py が古いままなら失敗する)
+# WebP版の作成には Pillow が必要。ビルド時だけ使うので requirements.txt には含めない (pip install Pillow してから実行)
+app.config['ASSET_DIST_DIR'] = 'dist'
+app.config['ASSET_MAX_AGE'] = int(os.environ.get('ASSET_MAX_AGE', 31536000))
+# WebP版のブキ画像の最大サイズ (px)。一覧では最大96px (メイン) で表示するので、高解像度の画面向けに2倍まで残す
+app.config['ASSET_WEBP_MAX_SIZE'] = int(os.environ.get('ASSET_WEBP_MAX_SIZE', 192))
+
+# --- 計測 ---
+# 処理ごとの時間を Server-Timing ヘッダーで返す
+app.config['SERVER_TIMING_ENABLED'] = os.environ.get('SERVER_TIMING_ENABLED', '1') == '1'
+# /metrics (Prometheus形式) を公開する。METRICS_TOKEN を設定すると Authorization: Bearer <token> が必要
+# 既定では METRICS_TOKEN を設定したときだけ公開する (トークンなしで公開するには METRICS_ENABLED=1)
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN', '')
+app.config['METRICS_ENABLED'] = os.environ.get('METRICS_ENABLED', '1' if app.config['METRICS_TOKEN'] else '0') == '1'
+# 設定すると ?_profile=<token> または X-Profile: <token> を付けたリクエストをサンプリングプロファイラで計測し、
+# レスポンスの代わりにスタックの集計 (flamegraph用のfolded形式) を返す
+app.config['PROFILER_TOKEN'] = os.environ.get('PROFILER_TOKEN', '')
+app.config['PROFILER_INTERVAL_MS'] = float(os.environ.get('PROFILER_INTERVAL_MS', 2))
+
 db = SQLAlchemy(app)
 
+# --- リクエストの計測 ---
+# ルートごとのレイテンシのヒストグラム、DBクエリの回数と時間、テンプレートの描画時間などを集計する
+# (集計はプロセスごとなので、サーバーレスではインスタンスごとの値になる)
+class Histogram:
+    buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.sum += seconds
+
+    def exposition(self, name, labels):
+        # 累積のバケットと _sum / _count の行を返す
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{format_labels(dict(labels, le=bound))} {cumulative}')
+        lines.append(f'{name}_sum{format_labels(labels)} {self.sum}')
+        lines.append(f'{name}_count{format_labels(labels)} {cumulative}')
+        return lines
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels.items()) + '}'
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.durations = {}
+        self.responses = Counter()
+        self.phases = {}
+        self.db_queries = Counter()
+        self.query_durations = Histogram()
+
+    def observe_request(self, endpoint, method, status, seconds, timings, db_queries):
+        with self.lock:
+            self.durations.setdefault((endpoint, method), Histogram()).observe(seconds)
+            self.responses[(endpoint, method, status)] += 1
+            self.db_queries[endpoint] += db_queries
+            for phase, phase_seconds in timings.items():
+                totals = self.phases.setdefault((endpoint, phase), [0.0, 0])
+                totals[0] += phase_seconds
+                totals[1] += 1
+
+    def observe_query(self, seconds):
+        with self.lock:
+            self.query_durations.observe(seconds)
+
+    def exposition(self):
+        lines = []
+        with self.lock:
+            lines.append('# HELP http_request_duration_seconds Request latency by route.')
+            lines.append('# TYPE http_request_duration_seconds histogram')
+            for (endpoint, method), histogram in sorted(self.durations.items()):
+                lines.extend(histogram.exposition('http_request_duration_seconds', {'endpoint': endpoint, 'method': method}))
+
+            lines.append('# HELP http_requests_total Responses by route and status code.')
+            lines.append('# TYPE http_requests_total counter')
+            for (endpoint, method, status), count in sorted(self.responses.items()):
+                labels = format_labels({'endpoint': endpoint, 'method': method, 'status': status})
+                lines.append(f'http_requests_total{labels} {count}')
+
+            lines.append('# HELP http_request_phase_seconds Time spent in each phase of a request (db, render, json, ...).')
+            lines.append('# TYPE http_request_phase_seconds summary')
+            for (endpoint, phase), (seconds, count) in sorted(self.phases.items()):
+                labels = format_labels({'endpoint': endpoint, 'phase': phase})
+                lines.append(f'http_request_phase_seconds_sum{labels} {seconds}')
+                lines.append(f'http_request_phase_seconds_count{labels} {count}')
+
+            lines.append('# HELP http_request_db_queries_total Database queries issued while handling requests.')
+            lines.append('# TYPE http_request_db_queries_total counter')
+            for endpoint, count in sorted(self.db_queries.items()):
+                lines.append(f'http_request_db_queries_total{format_labels({"endpoint": endpoint})} {count}')
+
+            lines.append('# HELP db_query_duration_seconds Database query latency (including background work).')
+            lines.append('# TYPE db_query_duration_seconds histogram')
+            lines.extend(self.query_durations.exposition('db_query_duration_seconds', {}))
+
+        with db_pool_stats_lock:
+            pool_stats = dict(db_pool_stats)
+        for kind in ('connect', 'checkout'):
+            lines.append(f'# TYPE db_pool_{kind}s_total counter')
+            lines.append(f'db_pool_{kind}s_total {pool_stats[f"{kind}s"]}')
+            lines.append(f'# TYPE db_pool_{kind}_seconds_total counter')
+            lines.append(f'db_pool_{kind}_seconds_total {pool_stats[f"{kind}_seconds_total"]}')
+            lines.append(f'# TYPE db_pool_{kind}_seconds_max gauge')
+            lines.append(f'db_pool_{kind}_seconds_max {pool_stats[f"{kind}_seconds_max"]}')
+        lines.append('# TYPE db_pool_checkout_errors_total counter')
+        lines.append(f'db_pool_checkout_errors_total {pool_stats["checkout_errors"]}')
+        lines.append('# TYPE db_pool_invalidations_total counter')
+        lines.append(f'db_pool_invalidations_total {pool_stats["invalidations"]}')
+        return '\n'.join(lines) + '\n'
+
+
+request_metrics = RequestMetrics()
+
+
+def add_timing(phase, seconds):
+    # リクエスト中なら処理時間を phase ごとに積算する (同じ phase が何度あっても合計する)
+    if has_request_context() and 'timings' in g:
+        g.timings[phase] = g.timings.get(phase, 0.0) + seconds
+
+
+def app_context_if_needed():
+    # バックグラウンドのスレッドではアプリケーションコンテキストを作り、既にあればそれを使う
+    # (リクエスト中に別のコンテキストを作ると g が分かれ、そのクエリがリクエストの計測から漏れる)
+    return nullcontext() if has_app_context() else app.app_context()
+
+
+@contextmanager
+def timed_phase(phase):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_timing(phase, time.perf_counter() - started)
+
+
+# クエリの計測は Engine クラスに付けて、別のbind (vote_quota) のエンジンも対象にする
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def stop_query_timer(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_started'].pop()
+    request_metrics.observe_query(elapsed)
+    if has_request_context() and 'timings' in g:
+        g.db_queries += 1
+        add_timing('db', elapsed)
+
+
+@event.listens_for(Engine, 'handle_error')
+def discard_query_timer(exception_context):
+    connection = exception_context.connection
+    if connection is not None and connection.info.get('query_started'):
+        connection.info['query_started'].pop()
+
+
+@before_render_template.connect_via(app)
+def start_render_timer(sender, template, context, **extra):
+    if has_request_context():
+        g.render_started = time.perf_counter()
+
+
+@template_rendered.connect_via(app)
+def stop_render_timer(sender, template, context, **extra):
+    if has_request_context() and 'render_started' in g:
+        add_timing('render', time.perf_counter() - g.pop('render_started'))
+
+
+class TimedJSONProvider(DefaultJSONProvider):
+    # jsonify() のシリアライズ時間も計測する
+    def response(self, *args, **kwargs):
+        with timed_phase('json'):
+            return super().response(*args, **kwargs)
+
+
+app.json = TimedJSONProvider(app)
+
+
+class SamplingProfiler:
+    # 対象のスレッドのスタックを interval ごとに記録し、folded形式 (関数;関数;... 回数) で集計する
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+                frame = frame.f_back
+            if stack:
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def folded(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in self.samples.most_common())
+
+
+def profiling_requested():
+    token = app.config['PROFILER_TOKEN']
+    if not token:
+        return False
+    return token in (request.args.get('_profile'), request.headers.get('X-Profile'))
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    g.timings = {}
+    g.db_queries = 0
+    if profiling_requested():
+        g.profiler = SamplingProfiler(threading.get_ident(), app.config['PROFILER_INTERVAL_MS'] / 1000)
+        g.profiler.start()
+
+
+@app.after_request
+def record_request_timing(response):
+    if 'request_started' not in g:
+        return response
+    elapsed = time.perf_counter() - g.request_started
+    endpoint = request.endpoint or 'unmatched'
+    request_metrics.observe_request(endpoint, request.method, response.status_code, elapsed, g.timings, g.db_queries)
+
+    if app.config['SERVER_TIMING_ENABLED']:
+        entries = []
+        for phase, seconds in g.timings.items():
+            entry = f'{phase};dur={seconds * 1000:.2f}'
+            if phase == 'db':
+                entry += f';desc="{g.db_queries} queries"'
+            entries.append(entry)
+        entries.append(f'total;dur={elapsed * 1000:.2f}')
+        response.headers['Server-Timing'] = ', '.join(entries)
+
+    if 'profiler' in g:
+        profiler = g.pop('profiler')
+        profiler.stop()
+        profile = app.response_class(profiler.folded(), mimetype='text/plain')
+        profile.headers['Server-Timing'] = response.headers.get('Server-Timing', '')
+        profile.headers['X-Profile-Samples'] = str(sum(profiler.samples.values()))
+        profile.headers['Cache-Control'] = 'no-store'
+        return profile
+    return response
+
 # --- レートリミット設定 (変更なし) ---
 def get_real_ip():
     if request.headers.getlist("X-Forwarded-For"):
@@ -45,6 +540,72 @@ class Votes(db.Model):
     def __repr__(self):
         return f'<Vote {self.weapon_id}>'
 
+
+# 投票数順の並べ替え (ランキング/一覧) とキーセットの条件用。ORDER BY vote_count DESC, weapon_id ASC と同じ向きにする
+db.Index('ix_votes_vote_count_desc_weapon_id', Votes.vote_count.desc(), Votes.weapon_id)
+
+
+class VoteShards(db.Model):
+    # シャード方式の未集約の票 (votes.vote_count との合計が実際の投票数)
+    __tablename__ = 'vote_shards'
+    weapon_id = db.Column(db.Integer, primary_key=True)
+    shard = db.Column(db.SmallInteger, primary_key=True)
+    vote_count = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<VoteShard {self.weapon_id}/{self.shard}>'
+
+
+class VoteBuckets(db.Model):
+    # 時間ごとの投票数 (bucket_seconds は 60 または 3600、bucket_start はバケットの開始時刻のUNIX秒)
+    __tablename__ = 'vote_buckets'
+    weapon_id = db.Column(db.Integer, primary_key=True)
+    bucket_seconds = db.Column(db.Integer, primary_key=True)
+    bucket_start = db.Column(db.BigInteger, primary_key=True)
+    vote_count = db.Column(db.Integer, nullable=False, default=0)
+
+    # 期間での読み込みと古いバケットの削除用
+    __table_args__ = (db.Index('ix_vote_buckets_seconds_start', 'bucket_seconds', 'bucket_start'),)
+
+    def __repr__(self):
+        return f'<VoteBucket {self.weapon_id} {self.bucket_seconds}@{self.bucket_start}>'
+
+
+class VoteQuota(db.Model):
+    # クライアントごと・日ごとの投票数 (client_key はIPアドレスのハッシュ)
+    __bind_key__ = 'quota' if app.config['QUOTA_DATABASE_URL'] else None
+    __tablename__ = 'vote_quota'
+    client_key = db.Column(db.String(64), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    vote_count = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<VoteQuota {self.client_key} {self.day}>'
+
+
+class SchemaMeta(db.Model):
+    # 初期化済みのスキーマ/カタログの目印 (一致していれば起動時の初期化を丸ごと省略する)
+    __tablename__ = 'schema_meta'
+    key = db.Column(db.String(64), primary_key=True)
+    value = db.Column(db.String(128), nullable=False)
+
+    def __repr__(self):
+        return f'<SchemaMeta {self.key}>'
+
+
+class Kits(db.Model):
+    # キット属性のディメンションテーブル (kit_id は votes.weapon_id と同じ)
+    __tablename__ = 'kits'
+    kit_id = db.Column(db.Integer, primary_key=True)
+    main_id = db.Column(db.SmallInteger, nullable=False, index=True)
+    main_type = db.Column(db.String(32), nullable=False, index=True)
+    sub_id = db.Column(db.SmallInteger, nullable=False, index=True)
+    special_id = db.Column(db.SmallInteger, nullable=False, index=True)
+    excluded = db.Column(db.Boolean, nullable=False, default=False)
+
+    def __repr__(self):
+        return f'<Kit {self.kit_id}>'
+
 # --- 武器データの定義 (変更なし) ---
 main_weapons_list = [
     {"name": "わかばシューター", "type": "シューター", "image": "Splattershot_Jr.png"},
@@ -346,40 +907,1888 @@ excluded_kits = [
 # 高速でチェックできるようにリストをセットに変換
 excluded_kits_set = set(excluded_kits)
 
-all_combinations = list(itertools.product(main_weapons_list, sub_weapons_list, special_weapons_list))
+# --- キット (メイン×サブ×スペシャルの組み合わせ) ---
+# キットIDは (メイン, サブ, スペシャル) の全組み合わせを順に並べたときの位置で、
+# 各ブキの位置は割り算で求まるので、組み合わせごとのデータは持たない
+num_combinations = len(main_weapons_list) * len(sub_weapons_list) * len(special_weapons_list)
+
+# 名前 -> リスト内の位置 (kitsテーブルの sub_id / special_id に対応)
+sub_id_by_name = {sub['name']: i for i, sub in enumerate(sub_weapons_list)}
+special_id_by_name = {special['name']: i for i, special in enumerate(special_weapons_list)}
+
+# 一覧ページのプルダウンの選択肢 (リクエストごとに作り直さない)
+weapon_type_names = tuple(dict.fromkeys(weapon['type'] for weapon in main_weapons_list))
+sub_weapon_names = tuple(sub['name'] for sub in sub_weapons_list)
+special_weapon_names = tuple(special['name'] for special in special_weapons_list)
+
+
+def kit_attributes(kit_id):
+    # キットIDから (main_id, sub_id, special_id) を求める
+    kit_id, special_id = divmod(kit_id, len(special_weapons_list))
+    main_id, sub_id = divmod(kit_id, len(sub_weapons_list))
+    return main_id, sub_id, special_id
+
+
+def kit_parts(kit_id):
+    # キットIDから (メイン, サブ, スペシャル) のブキデータを返す
+    main_id, sub_id, special_id = kit_attributes(kit_id)
+    return main_weapons_list[main_id], sub_weapons_list[sub_id], special_weapons_list[special_id]
+
+
+# --- 静的ファイルのビルド ---
+css_url_pattern = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)""")
+
+
+def load_asset_manifest():
+    path = os.path.join(app.static_folder, app.config['ASSET_DIST_DIR'], 'manifest.json')
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'assets': {}, 'webp': {}}
+
+
+asset_manifest = load_asset_manifest()
+
+
+def asset_url(filename):
+    # static 以下のパスを、ビルド済みならハッシュ付きのファイルのURLにする
+    return f"{app.static_url_path}/{asset_manifest['assets'].get(filename, filename)}"
+
+
+def webp_asset_url(filename):
+    # ビルド時にWebP版を作っていればそのURLを、なければNoneを返す
+    path = asset_manifest['webp'].get(filename)
+    return f"{app.static_url_path}/{path}" if path else None
+
+
+app.jinja_env.globals['asset_url'] = asset_url
+
+
+def hashed_asset_path(filename, content):
+    stem, ext = os.path.splitext(filename)
+    return f"{app.config['ASSET_DIST_DIR']}/{stem}.{hashlib.sha1(content).hexdigest()[:10]}{ext}"
+
+
+def build_static_assets():
+    # static 以下のファイルをハッシュ付きのファイル名で static/dist にコピーし、manifest.json を書く
+    # Pillow があればブキ画像の縮小したWebP版も作る (PNGより小さい場合のみ)
+    try:
+        from PIL import Image
+    except ImportError:
+        Image = None
+
+    dist_dir = os.path.join(app.static_folder, app.config['ASSET_DIST_DIR'])
+    shutil.rmtree(dist_dir, ignore_errors=True)
+    manifest = {'assets': {}, 'webp': {}}
+
+    def write(path, content):
+        target = os.path.join(app.static_folder, path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, 'wb') as f:
+            f.write(content)
+
+    sources = []
+    for folder, _, files in os.walk(app.static_folder):
+        relative_folder = os.path.relpath(folder, app.static_folder).replace(os.sep, '/')
+        if relative_folder == app.config['ASSET_DIST_DIR'] or relative_folder.startswith(app.config['ASSET_DIST_DIR'] + '/'):
+            continue
+        for name in files:
+            sources.append(name if relative_folder == '.' else f'{relative_folder}/{name}')
+
+    # CSSは中の url() を書き換えてからハッシュを取るので、参照先のファイルを先に処理する
+    for filename in sorted(sources, key=lambda name: (name.endswith('.css'), name)):
+        with open(os.path.join(app.static_folder, filename), 'rb') as f:
+            content = f.read()
+
+        if filename.endswith('.css'):
+            css_folder = os.path.dirname(filename)
+
+            def rewrite(match):
+                target = os.path.normpath(os.path.join(css_folder, match.group(2))).replace(os.sep, '/')
+                if target not in manifest['assets']:
+                    return match.group(0)
+                relative = os.path.relpath(manifest['assets'][target], f"{app.config['ASSET_DIST_DIR']}/{css_folder}")
+                return f"url('{relative.replace(os.sep, '/')}')"
+
+            content = css_url_pattern.sub(rewrite, content.decode('utf-8')).encode('utf-8')
+
+        path = hashed_asset_path(filename, content)
+        write(path, content)
+        manifest['assets'][filename] = path
+
+        if Image is not None and filename.startswith('images/') and filename.endswith('.png'):
+            with Image.open(os.path.join(app.static_folder, filename)) as image:
+                image.thumbnail((app.config['ASSET_WEBP_MAX_SIZE'], app.config['ASSET_WEBP_MAX_SIZE']))
+                buffer = io.BytesIO()
+                image.save(buffer, format='WEBP', quality=85)
+            webp = buffer.getvalue()
+            if len(webp) < len(content):
+                webp_path = hashed_asset_path(os.path.splitext(filename)[0] + '.webp', webp)
+                write(webp_path, webp)
+                manifest['webp'][filename] = webp_path
+
+    write(f"{app.config['ASSET_DIST_DIR']}/manifest.json",
+          json.dumps(manifest, indent=2, ensure_ascii=False, sort_keys=True).encode('utf-8'))
+    return manifest, Image is not None
+
+
+@app.cli.command('build-assets')
+def build_assets_command():
+    manifest, webp_enabled = build_static_assets()
+    print(f"Wrote {len(manifest['assets'])} assets and {len(manifest['webp'])} WebP variants "
+          f"to static/{app.config['ASSET_DIST_DIR']}.")
+    if not webp_enabled:
+        print("Pillow is not installed, so WebP variants were skipped (pip install Pillow).")
+
+
+@app.after_request
+def set_asset_cache_headers(response):
+    # ハッシュ付きのファイルは内容が変わらないので immutable でキャッシュさせる
+    if request.endpoint == 'static' and response.status_code == 200 \
+            and request.view_args.get('filename', '').startswith(app.config['ASSET_DIST_DIR'] + '/'):
+        response.headers['Cache-Control'] = f"public, max-age={app.config['ASSET_MAX_AGE']}, immutable"
+    return response
+
+
+# 画像のURLは起動時に一度だけ作り、描画のたびに url_for を呼ばない
+def static_image_urls(folder, weapons):
+    return [sys.intern(asset_url(f"images/{folder}/{weapon['image']}")) for weapon in weapons]
+
+
+def static_webp_urls(folder, weapons):
+    return [webp_asset_url(f"images/{folder}/{weapon['image']}") for weapon in weapons]
+
+
+main_image_urls = static_image_urls('main', main_weapons_list)
+sub_image_urls = static_image_urls('sub', sub_weapons_list)
+special_image_urls = static_image_urls('special', special_weapons_list)
+main_webp_urls = static_webp_urls('main', main_weapons_list)
+sub_webp_urls = static_webp_urls('sub', sub_weapons_list)
+special_webp_urls = static_webp_urls('special', special_weapons_list)
+
+
+class Kit:
+    # 一覧に表示するキット1件分の軽量なビュー (ブキデータは共有し、IDと投票数だけを持つ)
+    __slots__ = ('id', 'vote_count', 'main_id', 'sub_id', 'special_id')
+
+    def __init__(self, kit_id, vote_count=0):
+        self.id = kit_id
+        self.vote_count = vote_count
+        self.main_id, self.sub_id, self.special_id = kit_attributes(kit_id)
+
+    @property
+    def main(self):
+        return main_weapons_list[self.main_id]
+
+    @property
+    def sub(self):
+        return sub_weapons_list[self.sub_id]
+
+    @property
+    def special(self):
+        return special_weapons_list[self.special_id]
+
+    @property
+    def main_image_url(self):
+        return main_image_urls[self.main_id]
+
+    @property
+    def sub_image_url(self):
+        return sub_image_urls[self.sub_id]
+
+    @property
+    def special_image_url(self):
+        return special_image_urls[self.special_id]
+
+    @property
+    def main_webp_url(self):
+        return main_webp_urls[self.main_id]
+
+    @property
+    def sub_webp_url(self):
+        return sub_webp_urls[self.sub_id]
+
+    @property
+    def special_webp_url(self):
+        return special_webp_urls[self.special_id]
+
+
+# --- カタログインデックス (起動時に一度だけ構築) ---
+# 除外キットを除いたIDを昇順のコンパクトな配列で持ち、
+# ブキ種/サブ/スペシャルごとのポスティングリストで絞り込みを行う
+# キットIDは全組み合わせ上の位置のまま (除外キットの分は欠番) なので、既存のIDは変わらない
+valid_kit_ids = array('H')
+kit_ids_by_type = {}
+kit_ids_by_sub = {}
+kit_ids_by_special = {}
+
+for i in range(num_combinations):
+    main, sub, special = kit_parts(i)
+    if (main['name'], sub['name'], special['name']) in excluded_kits_set:
+        continue
+    valid_kit_ids.append(i)
+    kit_ids_by_type.setdefault(main['type'], array('H')).append(i)
+    kit_ids_by_sub.setdefault(sub['name'], array('H')).append(i)
+    kit_ids_by_special.setdefault(special['name'], array('H')).append(i)
+
+# 投票・保存・ランキングの対象になる正規のキットIDと、除外されたキットID
+valid_kit_id_set = frozenset(valid_kit_ids)
+excluded_kit_ids = [i for i in range(num_combinations) if i not in valid_kit_id_set]
+
+
+@functools.lru_cache(maxsize=512)
+def filter_kit_ids(type_filter='all', sub_filter='all', special_filter='all'):
+    # 条件に一致するキットIDを昇順の配列で返す (戻り値は共有されるので変更しないこと)
+    postings = []
+    for index, key in ((kit_ids_by_type, type_filter),
+                       (kit_ids_by_sub, sub_filter),
+                       (kit_ids_by_special, special_filter)):
+        if key == 'all':
+            continue
+        posting = index.get(key)
+        if posting is None:
+            return array('H')
+        postings.append(posting)
+
+    if not postings:
+        return valid_kit_ids
+    if len(postings) == 1:
+        return postings[0]
+
+    # 短いリストから順に積集合を取る
+    postings.sort(key=len)
+    common = set(postings[0]).intersection(*postings[1:])
+    return array('H', sorted(common))
 
 
 # --- データベース初期化関数 (SQLAlchemy版) ---
-def init_db_postgres():
+# テーブル構成を変えたら上げる。カタログ (ブキの追加や除外キットの変更) の変化はフィンガープリントで検知する
+SCHEMA_VERSION = 6
+catalog_fingerprint = f"{SCHEMA_VERSION}:" + hashlib.sha1(valid_kit_ids.tobytes()).hexdigest()
+
+
+def schema_is_current():
+    try:
+        marker = db.session.get(SchemaMeta, 'catalog')
+    except (OperationalError, ProgrammingError):
+        # schema_meta テーブルがまだない
+        db.session.rollback()
+        return False
+    return marker is not None and marker.value == catalog_fingerprint
+
+
+def seed_votes():
+    # 正規のキットの行をまとめて作成する (既存の行はそのまま)
+    if db.engine.dialect.name == 'postgresql':
+        # 行の生成をDB側で行い、1文で済ませる
+        result = db.session.execute(db.text(
+            "INSERT INTO votes (weapon_id, vote_count) "
+            "SELECT g, 0 FROM generate_series(0, :last_id) AS g "
+            "WHERE g <> ALL(CAST(:excluded_ids AS integer[])) "
+            "ON CONFLICT DO NOTHING"
+        ), {'last_id': num_combinations - 1, 'excluded_ids': excluded_kit_ids})
+    else:
+        # executemany で一括挿入するためCoreのテーブルに対して実行
+        result = db.session.connection().execute(
+            dialect_insert(Votes.__table__).on_conflict_do_nothing(),
+            [{'weapon_id': i, 'vote_count': 0} for i in valid_kit_ids],
+        )
+    return result.rowcount
+
+
+def seed_kits():
+    # キットの行を作成し、カタログの変更 (除外キットの変更など) で属性が変わった既存の行も書き換える
+    if db.engine.dialect.name == 'postgresql':
+        per_main = len(sub_weapons_list) * len(special_weapons_list)
+        result = db.session.execute(db.text(
+            "INSERT INTO kits (kit_id, main_id, main_type, sub_id, special_id, excluded) "
+            "SELECT g, g / :per_main, (CAST(:main_types AS varchar[]))[g / :per_main + 1], "
+            "(g / :num_specials) % :num_subs, g % :num_specials, g = ANY(CAST(:excluded_ids AS integer[])) "
+            "FROM generate_series(0, :last_id) AS g "
+            "ON CONFLICT (kit_id) DO UPDATE SET main_id = EXCLUDED.main_id, main_type = EXCLUDED.main_type, "
+            "sub_id = EXCLUDED.sub_id, special_id = EXCLUDED.special_id, excluded = EXCLUDED.excluded "
+            "WHERE (kits.main_id, kits.main_type, kits.sub_id, kits.special_id, kits.excluded) IS DISTINCT FROM "
+            "(EXCLUDED.main_id, EXCLUDED.main_type, EXCLUDED.sub_id, EXCLUDED.special_id, EXCLUDED.excluded)"
+        ), {
+            'per_main': per_main,
+            'main_types': [main['type'] for main in main_weapons_list],
+            'num_subs': len(sub_weapons_list),
+            'num_specials': len(special_weapons_list),
+            'excluded_ids': excluded_kit_ids,
+            'last_id': num_combinations - 1,
+        })
+    else:
+        rows = []
+        for i in range(num_combinations):
+            main_id, sub_id, special_id = kit_attributes(i)
+            rows.append({
+                'kit_id': i, 'main_id': main_id, 'main_type': main_weapons_list[main_id]['type'],
+                'sub_id': sub_id, 'special_id': special_id, 'excluded': i not in valid_kit_id_set,
+            })
+        table = Kits.__table__
+        stmt = dialect_insert(table)
+        columns = ('main_id', 'main_type', 'sub_id', 'special_id', 'excluded')
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.kit_id],
+            set_={column: stmt.excluded[column] for column in columns},
+            where=db.or_(*(table.c[column] != stmt.excluded[column] for column in columns)),
+        )
+        result = db.session.connection().execute(stmt, rows)
+    return result.rowcount
+
+
+def init_db_postgres(force=False):
     with app.app_context():
         print("Initializing database...")
+        if not force and schema_is_current():
+            print("Database is already initialized.")
+            return
+
         db.create_all() # テーブルが存在しない場合のみ作成
+        # 既存テーブルに後から追加したインデックスを作成
+        # (以前の昇順の ix_votes_vote_count_weapon_id は DESC, ASC の並べ替えに使えないので削除する)
+        with db.engine.begin() as connection:
+            connection.execute(db.text("DROP INDEX IF EXISTS ix_votes_vote_count_weapon_id"))
+        for index in Votes.__table__.indexes:
+            index.create(db.engine, checkfirst=True)
+
+        # 除外キットの行は投票できないので削除する (以前のバージョンで作られた行の移行)
+        removed = db.session.query(Votes).filter(Votes.weapon_id.in_(excluded_kit_ids)) \
+            .delete(synchronize_session=False)
+        db.session.query(VoteShards).filter(VoteShards.weapon_id.in_(excluded_kit_ids)) \
+            .delete(synchronize_session=False)
+        if removed:
+            print(f"Removed {removed} vote entries of excluded kits.")
+
+        added_votes = seed_votes()
+        added_kits = seed_kits()
+        print(f"Added {added_votes} new vote entries and added or updated {added_kits} kit entries.")
+
+        db.session.merge(SchemaMeta(key='catalog', value=catalog_fingerprint))
+        db.session.commit()
+
+
+@app.cli.command('db-check')
+@click.option('--queries', default=20, help='Number of queries to run.')
+@click.option('--threads', default=1, help='Number of concurrent threads.')
+def db_check_command(queries, threads):
+    # 現在の接続プール設定でクエリを実行し、接続/取得の時間を表示する (SQLiteやローカルのPostgresで確認用)
+    def run(count):
+        for _ in range(count):
+            with app.app_context():
+                db.session.execute(db.text('SELECT 1'))
+
+    workers = [threading.Thread(target=run, args=(queries // threads,)) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    print(f"Profile: {app.config['DB_POOL_PROFILE']} ({db.engine.pool.__class__.__name__})")
+    for key, value in db_pool_stats.items():
+        print(f"{key}: {value:.4f}" if isinstance(value, float) else f"{key}: {value}")
+
+
+@app.cli.command('init-db')
+@click.option('--force', is_flag=True, help='Ignore the schema marker and check every table.')
+def init_db_command(force):
+    # デプロイ時に実行し、サーバーレスのコールドスタート中に初期化しないようにする
+    init_db_postgres(force=force)
 
-        num_combinations = len(all_combinations)
-        count = db.session.query(Votes).count()
-
-        if count < num_combinations:
-            print(f"Votes table is incomplete. Found {count}/{num_combinations}. Populating...")
-            # 既存のIDをセットとして取得
-            existing_ids = {v.weapon_id for v in db.session.query(Votes.weapon_id).all()}
-            
-            # 足りないIDのオブジェクトをリストに追加
-            new_votes = []
-            for i in range(num_combinations):
-                if i not in existing_ids:
-                    new_votes.append(Votes(weapon_id=i, vote_count=0))
-            
-            # 新しいオブジェクトを一括で追加
-            if new_votes:
-                db.session.bulk_save_objects(new_votes)
-                db.session.commit()
-                print(f"Added {len(new_votes)} new vote entries.")
+
+# --- 一覧ページのデータ取得 ---
+# RANKING_MODE=sql の投票数順で、絞り込み後のキットがこの件数以下なら IN 句でその分だけ投票数を読む (超えたら全件を読む)
+GRID_VOTE_FETCH_LIMIT = 2000
+
+
+def grid_page_from_index(type_filter, sub_filter, special_filter, sort_order, start, end):
+    # カタログインデックスで絞り込み、(id, 投票数) のリストと総件数を返す
+    kit_ids = filter_kit_ids(type_filter, sub_filter, special_filter)
+
+    if sort_order in ('votes_desc', 'votes_asc') and ranking_engine is not None:
+        # 投票数順はメモリ上のランキングから切り出す (絞り込みがあればランキング順にたどって対象のキットだけ残す)
+        if kit_ids is not valid_kit_ids:
+            rows = ranking_engine.filtered_page(set(kit_ids), start, end - start, sort_order == 'votes_asc')
+        elif sort_order == 'votes_desc':
+            rows = ranking_engine.page(start, end - start)
         else:
-            print("Database is already initialized.")
+            rows = ranking_engine.ascending_page(start, end - start)
+        return rows, len(kit_ids)
+    elif sort_order in ('votes_desc', 'votes_asc'):
+        # RANKING_MODE=sql の場合。絞り込み後の件数が少なければその分だけ投票数を取得する
+        # (同数の場合はID順を維持する安定ソート)
+        votes_dict = fetch_vote_counts(kit_ids) if len(kit_ids) <= GRID_VOTE_FETCH_LIMIT else fetch_vote_counts()
+        sorted_ids = sorted(kit_ids, key=lambda i: votes_dict.get(i, 0), reverse=(sort_order == 'votes_desc'))
+        page_ids = sorted_ids[start:end]
+    elif sort_order == 'trending':
+        page_ids = trending_kit_ids(kit_ids, start, end)
+        votes_dict = fetch_vote_counts(page_ids) if page_ids else {}
+    else:
+        # 種類順はインデックスの並びそのままなので、ページ分だけ切り出して投票数を取得
+        page_ids = kit_ids[start:end]
+        votes_dict = fetch_vote_counts(page_ids) if page_ids else {}
+
+    return [(i, votes_dict.get(i, 0)) for i in page_ids], len(kit_ids)
+
+
+def grid_page_from_sql(type_filter, sub_filter, special_filter, sort_order, start, end):
+    # kitsテーブルと結合し、絞り込み・並べ替え・ページ分けを1本のクエリで行う
+    totals = vote_totals()
+    vote_count = db.func.coalesce(totals.c.vote_count, 0)
+    query = (
+        db.session.query(Kits.kit_id, vote_count)
+        .outerjoin(totals, totals.c.weapon_id == Kits.kit_id)
+        .filter(Kits.excluded.is_(False))
+    )
+    if type_filter != 'all':
+        query = query.filter(Kits.main_type == type_filter)
+    if sub_filter != 'all':
+        if sub_filter not in sub_id_by_name:
+            return [], 0
+        query = query.filter(Kits.sub_id == sub_id_by_name[sub_filter])
+    if special_filter != 'all':
+        if special_filter not in special_id_by_name:
+            return [], 0
+        query = query.filter(Kits.special_id == special_id_by_name[special_filter])
+
+    total = query.with_entities(db.func.count(Kits.kit_id)).scalar()
+    if start < 0 or end <= start:
+        return [], total
+
+    if sort_order == 'votes_desc':
+        query = query.order_by(vote_count.desc(), Kits.kit_id.asc())
+    elif sort_order == 'votes_asc':
+        query = query.order_by(vote_count.asc(), Kits.kit_id.asc())
+    else:
+        query = query.order_by(Kits.kit_id.asc())
+
+    rows = query.limit(end - start).offset(start).all()
+    return [(row[0], row[1]) for row in rows], total
+
+
+# --- 投票数の読み書き ---
+def vote_totals():
+    # (weapon_id, vote_count) の列を持つテーブル/サブクエリを返す
+    # シャード方式ではvotesの値に未集約のシャード分を合算する
+    if app.config['VOTE_STORAGE'] != 'sharded':
+        return Votes.__table__
+
+    shard_sums = (
+        db.select(VoteShards.weapon_id, db.func.sum(VoteShards.vote_count).label('vote_count'))
+        .group_by(VoteShards.weapon_id)
+        .subquery('shard_sums')
+    )
+    return (
+        db.select(
+            Votes.weapon_id,
+            (Votes.vote_count + db.func.coalesce(shard_sums.c.vote_count, 0)).label('vote_count'),
+        )
+        .outerjoin(shard_sums, shard_sums.c.weapon_id == Votes.weapon_id)
+        .subquery('vote_totals')
+    )
+
+
+def fetch_vote_counts(weapon_ids=None):
+    # {weapon_id: 投票数} を返す (weapon_ids を省略すると全件)
+    totals = vote_totals()
+    query = db.session.query(totals.c.weapon_id, totals.c.vote_count)
+    if weapon_ids is not None:
+        query = query.filter(totals.c.weapon_id.in_(list(weapon_ids)))
+    return dict(query.all())
+
+
+def fetch_vote_count(weapon_id):
+    return fetch_vote_counts([weapon_id]).get(weapon_id)
+
+
+def dialect_insert(model, engine=None):
+    # ON CONFLICT 句を使うためのDBごとのINSERT文
+    if (engine or db.engine).dialect.name == 'postgresql':
+        return postgresql.insert(model)
+    return sqlite.insert(model)
+
+
+def apply_vote_increments(increments):
+    # {weapon_id: n} を1トランザクションでアトミックに加算し、更新後の {weapon_id: 投票数} を返す
+    # (存在しないIDは結果に含まれない)。履歴を投票ごとに書く設定なら、同じトランザクションで履歴にも加算する
+    if app.config['VOTE_STORAGE'] == 'sharded':
+        new_counts = apply_sharded_vote_increments(increments)
+    else:
+        new_counts = apply_single_vote_increments(increments)
+    if not new_counts:
+        # 1件も加算されなかった。同じトランザクションで数えた投票回数もあわせて戻す
+        db.session.rollback()
+        return new_counts
+    if vote_history is not None and vote_history.write_through:
+        vote_history.stage({weapon_id: n for weapon_id, n in increments.items() if weapon_id in new_counts},
+                           time.time())
+    db.session.commit()
+    return new_counts
+
+
+def apply_single_vote_increments(increments):
+    # UPDATE votes SET vote_count = vote_count + CASE weapon_id WHEN ... END WHERE weapon_id IN (...)
+    # の1文で複数のキットをまとめて加算する
+    stmt = (
+        db.update(Votes)
+        .where(Votes.weapon_id.in_(sorted(increments)))
+        .values(vote_count=Votes.vote_count + db.case(increments, value=Votes.weapon_id, else_=0))
+        .returning(Votes.weapon_id, Votes.vote_count)
+        .execution_options(synchronize_session=False)
+    )
+    return dict(db.session.execute(stmt).all())
+
+
+def apply_sharded_vote_increments(increments):
+    # ランダムに選んだシャード行に加算し、votes の行ロックを取らないようにする
+    shard_count = app.config['VOTE_SHARD_COUNT']
+    rows = [
+        {'weapon_id': weapon_id, 'shard': random.randrange(shard_count), 'vote_count': n}
+        for weapon_id, n in sorted(increments.items())
+    ]
+    stmt = dialect_insert(VoteShards).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[VoteShards.weapon_id, VoteShards.shard],
+        set_={'vote_count': VoteShards.vote_count + stmt.excluded.vote_count},
+    )
+    db.session.execute(stmt)
+    return fetch_vote_counts(increments.keys())
+
+
+def compact_vote_shards():
+    # シャードの票をvotesへ集約する。読み取った分だけシャードから差し引くので、
+    # 集約中に加算された票は失われず次回に持ち越される
+    shard_rows = db.session.query(VoteShards.weapon_id, VoteShards.shard, VoteShards.vote_count) \
+        .filter(VoteShards.vote_count != 0).all()
+    if not shard_rows:
+        return 0
+
+    totals = Counter()
+    for weapon_id, shard, vote_count in shard_rows:
+        totals[weapon_id] += vote_count
+
+    # executemany で一括更新するためCoreのテーブルに対して実行
+    shards_table = VoteShards.__table__
+    votes_table = Votes.__table__
+    connection = db.session.connection()
+    connection.execute(
+        shards_table.update()
+        .where(shards_table.c.weapon_id == db.bindparam('b_weapon_id'),
+               shards_table.c.shard == db.bindparam('b_shard'))
+        .values(vote_count=shards_table.c.vote_count - db.bindparam('b_vote_count')),
+        [{'b_weapon_id': w, 'b_shard': s, 'b_vote_count': c} for w, s, c in shard_rows],
+    )
+    connection.execute(
+        votes_table.update()
+        .where(votes_table.c.weapon_id == db.bindparam('b_weapon_id'))
+        .values(vote_count=votes_table.c.vote_count + db.bindparam('b_vote_count')),
+        [{'b_weapon_id': w, 'b_vote_count': c} for w, c in sorted(totals.items())],
+    )
+    db.session.execute(db.delete(VoteShards).where(VoteShards.vote_count == 0))
+    db.session.commit()
+    return sum(totals.values())
+
+
+class VoteBuffer:
+    # 投票をweapon_idごとにメモリ上で集約し、一定間隔または一定票数ごとにまとめてDBへ書き込む
+    # ジャーナルを使うプロセスの最大数 (path, path.1, ... のうちロックを取れたファイルを使う)
+    journal_slots = 32
+
+    def __init__(self, flush_interval, max_pending, journal_path=None):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.pending = Counter()
+        self.pending_total = 0
+        self.in_flight = Counter()
+        self.known_counts = {}
+        self.thread = None
+
+        self.journal = None
+        self.journal_lock = None
+        self.journal_seq = 0
+        if journal_path:
+            self._open_journal(journal_path)
+
+    def _open_journal(self, path):
+        # 同じファイルを複数のプロセスが再生して票を二重に書き込まないよう、ファイルごとに排他ロックを取る
+        # 再起動したプロセスは空いているファイルを引き継ぎ、残っている票を書き戻す
+        # DBへのコミット後、ジャーナルから消す前に落ちるとその票は再起動時にもう一度加算される (at-least-once)
+        try:
+            import fcntl
+        except ImportError:
+            fcntl = None  # Windows ではロックせずに path をそのまま使う
+
+        orphans = []
+        if fcntl is not None:
+            slot_paths = [path] + [f'{path}.{slot}' for slot in range(1, self.journal_slots)]
+            for slot_path in slot_paths:
+                lock_file = self._lock_slot(fcntl, slot_path)
+                if lock_file is not None:
+                    self.journal_lock = lock_file
+                    path = slot_path
+                    break
+            else:
+                app.logger.warning("All vote buffer journals are in use; buffered votes are not journaled")
+                return
+            # 前より少ないプロセス数で再起動すると、誰も使わないファイルに票が残る。
+            # ロックを取れた (持ち主のいない) ファイルの票は自分のジャーナルへ移す
+            for slot_path in slot_paths:
+                if slot_path != path and os.path.exists(slot_path):
+                    lock_file = self._lock_slot(fcntl, slot_path)
+                    if lock_file is not None:
+                        orphans.append((slot_path, lock_file))
+
+        self.journal = self._connect_journal(path)
+        for orphan_path, lock_file in orphans:
+            try:
+                orphan = self._connect_journal(orphan_path)
+                rows = orphan.execute("SELECT weapon_id, n FROM pending_votes ORDER BY seq").fetchall()
+                if rows:
+                    self.journal.execute("BEGIN")
+                    self.journal.executemany("INSERT INTO pending_votes (weapon_id, n) VALUES (?, ?)", rows)
+                    self.journal.execute("COMMIT")
+                    orphan.execute("DELETE FROM pending_votes")
+                orphan.close()
+            finally:
+                lock_file.close()
+
+        # 前回書き込めなかった票を引き継ぐ
+        for weapon_id, n, max_seq in self.journal.execute(
+            "SELECT weapon_id, SUM(n), MAX(seq) FROM pending_votes GROUP BY weapon_id"
+        ):
+            self.pending[weapon_id] += n
+            self.pending_total += n
+            self.journal_seq = max(self.journal_seq, max_seq)
+        if self.pending:
+            # 次の投票を待たずに書き戻す
+            self._ensure_thread()
+
+    @staticmethod
+    def _lock_slot(fcntl, slot_path):
+        lock_file = open(slot_path + '.lock', 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return None
+        return lock_file
+
+    @staticmethod
+    def _connect_journal(path):
+        journal = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        journal.execute("PRAGMA journal_mode=WAL")
+        journal.execute("PRAGMA synchronous=NORMAL")
+        journal.execute(
+            "CREATE TABLE IF NOT EXISTS pending_votes "
+            "(seq INTEGER PRIMARY KEY, weapon_id INTEGER NOT NULL, n INTEGER NOT NULL)"
+        )
+        return journal
+
+    def add(self, weapon_id, n=1):
+        # 票を積み、DBへの書き込みを待たずに予想される新しい投票数を返す
+        with self.lock:
+            known = weapon_id in self.known_counts
+        if not known:
+            base = fetch_vote_count(weapon_id) or 0
+            with self.lock:
+                self.known_counts.setdefault(weapon_id, base)
+
+        with self.lock:
+            self.pending[weapon_id] += n
+            self.pending_total += n
+            if self.journal is not None:
+                cursor = self.journal.execute(
+                    "INSERT INTO pending_votes (weapon_id, n) VALUES (?, ?)", (weapon_id, n)
+                )
+                self.journal_seq = cursor.lastrowid
+            projected = self.known_counts[weapon_id] + self.in_flight[weapon_id] + self.pending[weapon_id]
+            if self.pending_total >= self.max_pending:
+                self.wakeup.set()
+
+        self._ensure_thread()
+        return projected
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                if not self.pending:
+                    return
+                batch = self.pending
+                flushed_seq = self.journal_seq
+                self.in_flight = batch
+                self.pending = Counter()
+                self.pending_total = 0
+
+            try:
+                with app_context_if_needed():
+                    new_counts = apply_vote_increments(batch)
+            except Exception:
+                # 書き込めなかった票はバッファに戻して次回に再試行する
+                with self.lock:
+                    self.pending.update(batch)
+                    self.pending_total += sum(batch.values())
+                    self.in_flight = Counter()
+                raise
+
+            with self.lock:
+                self.known_counts.update(new_counts)
+                self.in_flight = Counter()
+                if self.journal is not None:
+                    self.journal.execute("DELETE FROM pending_votes WHERE seq <= ?", (flushed_seq,))
+            # 他のインスタンスの票も含んだDB上の値で集計を更新
+            after_votes_applied(new_counts)
+
+    def _ensure_thread(self):
+        if self.thread is None or not self.thread.is_alive():
+            with self.lock:
+                if self.thread is None or not self.thread.is_alive():
+                    self.thread = threading.Thread(target=self._run, name='vote-buffer', daemon=True)
+                    self.thread.start()
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                app.logger.exception("Failed to flush buffered votes")
+
+
+# --- ランキング ---
+class SortedKeyList:
+    # 平方分割したソート済みリスト。全体を並べ替えずに挿入/削除/順位の取得/範囲の切り出しを行う
+    load = 512
+
+    def __init__(self, keys=()):
+        keys = sorted(keys)
+        self.lists = [keys[i:i + self.load] for i in range(0, len(keys), self.load)]
+        self.maxes = [sublist[-1] for sublist in self.lists]
+        self.size = len(keys)
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self.lists)
+
+    def add(self, key):
+        if not self.lists:
+            self.lists.append([key])
+            self.maxes.append(key)
+        else:
+            i = min(bisect.bisect_left(self.maxes, key), len(self.lists) - 1)
+            sublist = self.lists[i]
+            bisect.insort(sublist, key)
+            self.maxes[i] = sublist[-1]
+            if len(sublist) > self.load * 2:
+                self.lists[i:i + 1] = [sublist[:self.load], sublist[self.load:]]
+                self.maxes[i:i + 1] = [sublist[self.load - 1], sublist[-1]]
+        self.size += 1
+
+    def remove(self, key):
+        i = bisect.bisect_left(self.maxes, key)
+        sublist = self.lists[i]
+        del sublist[bisect.bisect_left(sublist, key)]
+        self.size -= 1
+        if sublist:
+            self.maxes[i] = sublist[-1]
+        else:
+            del self.lists[i]
+            del self.maxes[i]
+
+    def index(self, key):
+        # key より前にある要素の数 (0始まりの順位)
+        i = bisect.bisect_left(self.maxes, key)
+        if i == len(self.lists):
+            return self.size
+        return sum(len(sublist) for sublist in self.lists[:i]) + bisect.bisect_left(self.lists[i], key)
+
+    def slice(self, start, stop):
+        result = []
+        for sublist in self.lists:
+            if start >= len(sublist):
+                start -= len(sublist)
+                stop -= len(sublist)
+                continue
+            result.extend(sublist[max(start, 0):stop])
+            start = 0
+            stop -= len(sublist)
+            if stop <= 0:
+                break
+        return result
+
+    def after(self, key, limit):
+        # key より後ろの要素を先頭から limit 件返す (キーセットページネーション用)
+        result = []
+        i = bisect.bisect_right(self.maxes, key)
+        if i < len(self.lists):
+            sublist = self.lists[i]
+            result.extend(sublist[bisect.bisect_right(sublist, key):])
+            for sublist in self.lists[i + 1:]:
+                if len(result) >= limit:
+                    break
+                result.extend(sublist)
+        return result[:limit]
+
+
+class RankingEngine:
+    # (投票数の降順, weapon_id の昇順) に並べたランキングをメモリ上に保持する
+    # 投票のたびに差分で更新し、TTLが切れたらDBから読み直して他のインスタンスの票を取り込む
+    # 投票数は減らないので、同じキットの値が前後して届いたときは大きい方を残す
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # 読み直しは1つのスレッドだけが行い、他のリクエストは古い構造のまま読む
+        self.refresh_lock = threading.Lock()
+        self.counts = {}
+        self.keys = SortedKeyList()
+        self.loaded_at = None
+        # 読み直し中に apply された {weapon_id: 投票数} (読み込んだ値より新しいことがあるので後で反映する)
+        self.refresh_updates = None
+
+    @staticmethod
+    def make_key(weapon_id, vote_count):
+        return (-vote_count, weapon_id)
+
+    def is_stale(self):
+        return self.loaded_at is None or time.monotonic() - self.loaded_at > self.ttl
+
+    def refresh(self):
+        with self.refresh_lock:
+            self._refresh()
+
+    def _refresh(self):
+        with self.lock:
+            self.refresh_updates = {}
+        try:
+            counts = {
+                weapon_id: vote_count for weapon_id, vote_count in fetch_vote_counts().items()
+                if weapon_id in valid_kit_id_set
+            }
+        except Exception:
+            with self.lock:
+                self.refresh_updates = None
+            raise
+        with self.lock:
+            # 読み込みの間に届いた票を反映してから入れ替える
+            for weapon_id, vote_count in self.refresh_updates.items():
+                counts[weapon_id] = max(counts.get(weapon_id, 0), vote_count)
+            self.refresh_updates = None
+        keys = SortedKeyList(self.make_key(weapon_id, vote_count) for weapon_id, vote_count in counts.items())
+        with self.lock:
+            self.counts = counts
+            self.keys = keys
+            self.loaded_at = time.monotonic()
+
+    def ensure_fresh(self):
+        if not self.is_stale():
+            return
+        if self.loaded_at is not None:
+            # 読み込み済みなら、読み直しは空いているスレッドだけが行い、他は古い構造で応答する
+            if not self.refresh_lock.acquire(blocking=False):
+                return
+        else:
+            # 初回は読み込みが終わるまで待つ
+            self.refresh_lock.acquire()
+        try:
+            if self.is_stale():
+                self._refresh()
+        finally:
+            self.refresh_lock.release()
+
+    def apply(self, new_counts):
+        with self.lock:
+            if self.refresh_updates is not None:
+                for weapon_id, vote_count in new_counts.items():
+                    self.refresh_updates[weapon_id] = max(self.refresh_updates.get(weapon_id, 0), vote_count)
+            if self.loaded_at is None:
+                return
+            for weapon_id, vote_count in new_counts.items():
+                old_count = self.counts.get(weapon_id)
+                if (old_count is not None and vote_count <= old_count) or weapon_id not in valid_kit_id_set:
+                    continue
+                if old_count is not None:
+                    self.keys.remove(self.make_key(weapon_id, old_count))
+                self.keys.add(self.make_key(weapon_id, vote_count))
+                self.counts[weapon_id] = vote_count
+
+    def page(self, offset, limit, after=None):
+        # [(weapon_id, 投票数), ...] を返す。after=(投票数, weapon_id) を渡すとその次から
+        self.ensure_fresh()
+        with self.lock:
+            if after is not None:
+                keys = self.keys.after(self.make_key(after[1], after[0]), limit)
+            else:
+                keys = self.keys.slice(offset, offset + limit)
+        return [(weapon_id, -negative_count) for negative_count, weapon_id in keys]
+
+    def ascending_page(self, offset, limit):
+        # 投票数の昇順 (同数は weapon_id の昇順) で [(weapon_id, 投票数), ...] を返す
+        # 降順のリストを後ろから読み、同数のまとまりの中だけは前から読む
+        self.ensure_fresh()
+        with self.lock:
+            size = len(self.keys)
+            stop = min(offset + limit, size)
+            position = max(offset, 0)
+            keys = []
+            while position < stop:
+                negative_count = self.keys.slice(size - 1 - position, size - position)[0][0]
+                # 同数のまとまりは降順のリストの [first, last) にあり、昇順では [size - last, size - first) になる
+                first = self.keys.index((negative_count, -1))
+                last = self.keys.index((negative_count + 1, -1))
+                group_start = size - last
+                group_stop = min(stop, size - first)
+                keys.extend(self.keys.slice(first + position - group_start, first + group_stop - group_start))
+                position = group_stop
+        return [(weapon_id, -negative_count) for negative_count, weapon_id in keys]
+
+    def filtered_page(self, allowed, offset, limit, ascending=False):
+        # allowed に含まれるキットだけを並べた offset から limit 件を返す (絞り込んだ一覧ページの投票数順)
+        # ascending なら投票数の昇順。どちらも同数は weapon_id の昇順
+        self.ensure_fresh()
+        with self.lock:
+            matched = (key for key in self.keys if key[1] in allowed)
+            if ascending:
+                keys = sorted(matched, key=lambda key: (-key[0], key[1]))[offset:offset + limit]
+            else:
+                keys = list(itertools.islice(matched, offset, offset + limit))
+        return [(weapon_id, -negative_count) for negative_count, weapon_id in keys]
+
+    def rank(self, weapon_id):
+        # (1始まりの順位, 投票数) を返す
+        self.ensure_fresh()
+        with self.lock:
+            vote_count = self.counts.get(weapon_id)
+            if vote_count is None:
+                return None
+            return self.keys.index(self.make_key(weapon_id, vote_count)) + 1, vote_count
+
+
+ranking_engine = None
+if app.config['RANKING_MODE'] == 'memory':
+    ranking_engine = RankingEngine(app.config['RANKING_CACHE_TTL'])
+
+
+def ranking_page(offset, limit, after=None):
+    # ランキングの1ページ分を [(weapon_id, 投票数), ...] で返す
+    if ranking_engine is not None:
+        return ranking_engine.page(offset, limit, after)
+
+    totals = vote_totals()
+    # 移行前のDBに除外キットの行が残っていてもランキングには出さない
+    query = db.session.query(totals.c.weapon_id, totals.c.vote_count) \
+        .filter(totals.c.weapon_id.notin_(excluded_kit_ids))
+    if after is not None:
+        # OFFSET を使わず、前のページの最後の (投票数, weapon_id) より後ろから取得
+        after_count, after_id = after
+        query = query.filter(db.or_(
+            totals.c.vote_count < after_count,
+            db.and_(totals.c.vote_count == after_count, totals.c.weapon_id > after_id),
+        ))
+        offset = 0
+    rows = query.order_by(totals.c.vote_count.desc(), totals.c.weapon_id.asc()).limit(limit).offset(offset).all()
+    return [(row[0], row[1]) for row in rows]
+
+
+def ranking_position(weapon_id):
+    # (1始まりの順位, 投票数) を返す
+    if ranking_engine is not None:
+        return ranking_engine.rank(weapon_id)
+
+    totals = vote_totals()
+    vote_count = fetch_vote_count(weapon_id) if weapon_id in valid_kit_id_set else None
+    if vote_count is None:
+        return None
+    ahead = db.session.query(db.func.count()).select_from(totals).filter(
+        totals.c.weapon_id.notin_(excluded_kit_ids)
+    ).filter(db.or_(
+        totals.c.vote_count > vote_count,
+        db.and_(totals.c.vote_count == vote_count, totals.c.weapon_id < weapon_id),
+    )).scalar()
+    return ahead + 1, vote_count
+
+
+# --- 投票の履歴とトレンド ---
+class VoteHistory:
+    # 票を (分の開始時刻, weapon_id) ごとにメモリ上で集約し、一定間隔で分/時間のバケットへまとめて加算する
+    # (書き込みは投票数によらず間隔ごとに1文で、/vote のたびに履歴の行を書かない)
+    resolutions = (60, 3600)
+    batch_size = 500
+
+    def __init__(self, flush_interval, minute_retention, hour_retention):
+        self.flush_interval = flush_interval
+        # 間隔が0なら、投票と同じトランザクションでバケットに加算する (apply_vote_increments から stage を呼ぶ)
+        self.write_through = flush_interval <= 0
+        self.retention = {60: minute_retention, 3600: hour_retention}
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.pending = Counter()
+        self.in_flight = Counter()
+        # 起動直後 (サーバーレスのコールドスタートでは /vote の中) には削除を行わない
+        self.pruned_at = time.time()
+        self.thread = None
+
+    def add(self, increments, timestamp):
+        with self.lock:
+            self.pending.update(self._minute_batch(increments, timestamp))
+        self._ensure_thread()
+
+    def stage(self, increments, timestamp):
+        # 呼び出し元のトランザクションでバケットに加算する (コミットは呼び出し元で行う)
+        # 履歴は集計用なので、失敗してもセーブポイントまで戻して票の書き込みは続ける
+        try:
+            with db.session.begin_nested():
+                self._execute(self._minute_batch(increments, timestamp))
+        except Exception:
+            app.logger.exception("Failed to record vote history")
+
+    @staticmethod
+    def _minute_batch(increments, timestamp):
+        minute = int(timestamp) // 60 * 60
+        return Counter({(minute, weapon_id): n for weapon_id, n in increments.items()})
+
+    def unflushed(self):
+        # まだDBに書き込んでいない [((分の開始時刻, weapon_id), 票数), ...]
+        with self.lock:
+            return list((self.pending + self.in_flight).items())
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                if not self.pending:
+                    batch = None
+                else:
+                    batch = self.pending
+                    self.in_flight = batch
+                    self.pending = Counter()
+
+            if batch is not None:
+                try:
+                    with app_context_if_needed():
+                        self._write(batch)
+                except Exception:
+                    with self.lock:
+                        self.pending.update(batch)
+                    raise
+                finally:
+                    with self.lock:
+                        self.in_flight = Counter()
+
+            # 古いバケットの削除は1時間に1回
+            if time.time() - self.pruned_at > 3600:
+                with app_context_if_needed():
+                    self.prune(time.time())
+
+    def _write(self, batch):
+        self._execute(batch)
+        db.session.commit()
+
+    def _execute(self, batch):
+        buckets = Counter()
+        for (minute, weapon_id), n in batch.items():
+            for bucket_seconds in self.resolutions:
+                buckets[(weapon_id, bucket_seconds, minute // bucket_seconds * bucket_seconds)] += n
+        rows = [
+            {'weapon_id': weapon_id, 'bucket_seconds': bucket_seconds, 'bucket_start': bucket_start, 'vote_count': n}
+            for (weapon_id, bucket_seconds, bucket_start), n in sorted(buckets.items())
+        ]
+        for i in range(0, len(rows), self.batch_size):
+            stmt = dialect_insert(VoteBuckets).values(rows[i:i + self.batch_size])
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[VoteBuckets.weapon_id, VoteBuckets.bucket_seconds, VoteBuckets.bucket_start],
+                set_={'vote_count': VoteBuckets.vote_count + stmt.excluded.vote_count},
+            )
+            db.session.execute(stmt)
+
+    def prune(self, now):
+        # 保持期間を過ぎたバケットを削除し、削除した行数を返す
+        removed = 0
+        for bucket_seconds, retention in self.retention.items():
+            removed += db.session.query(VoteBuckets).filter(
+                VoteBuckets.bucket_seconds == bucket_seconds,
+                VoteBuckets.bucket_start < now - retention,
+            ).delete(synchronize_session=False)
+        db.session.commit()
+        self.pruned_at = now
+        return removed
+
+    def recent(self, since, now):
+        # since 以降の票を [(weapon_id, バケットの中央の時刻, 票数), ...] で返す
+        # 直近2時間は分ごとの集計、それより前は時間ごとの集計を使う (重ならないように境界は正時にする)
+        boundary = int(now) // 3600 * 3600 - 3600
+        rows = db.session.query(VoteBuckets.weapon_id, VoteBuckets.bucket_seconds,
+                                VoteBuckets.bucket_start, VoteBuckets.vote_count).filter(db.or_(
+            db.and_(VoteBuckets.bucket_seconds == 60, VoteBuckets.bucket_start >= boundary),
+            db.and_(VoteBuckets.bucket_seconds == 3600, VoteBuckets.bucket_start < boundary,
+                    VoteBuckets.bucket_start >= since),
+        )).all()
+        return [(weapon_id, start + seconds / 2, n) for weapon_id, seconds, start, n in rows]
+
+    def _ensure_thread(self):
+        if self.thread is None or not self.thread.is_alive():
+            with self.lock:
+                if self.thread is None or not self.thread.is_alive():
+                    self.thread = threading.Thread(target=self._run, name='vote-history', daemon=True)
+                    self.thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                app.logger.exception("Failed to flush vote history")
+
+
+class TrendingEngine:
+    # キットごとの指数減衰したスコア Σ n·exp(-λ(now - t)) を、対数 key = log Σ n·exp(λ(t - epoch)) で保持する
+    # 全キットが同じ割合で減衰するので、並び順は投票があったときだけ変わり、時間の経過では変わらない
+    # (投票ごとに key を差分で更新し、TTLごとに履歴のバケットから読み直して他のインスタンスの票を取り込む)
+    epoch = 1735689600  # 2025-01-01T00:00:00Z
+
+    def __init__(self, history, half_life, ttl):
+        self.history = history
+        self.decay = math.log(2) / half_life
+        # 半減期の20倍 (100万分の1) より前の票は読み直しのときに無視する
+        self.window = half_life * 20
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.scores = {}
+        self.keys = SortedKeyList()
+        self.loaded_at = None
+
+    def log_weight(self, n, timestamp):
+        return math.log(n) + self.decay * (timestamp - self.epoch)
+
+    @staticmethod
+    def log_add(a, b):
+        if a is None:
+            return b
+        high, low = (a, b) if a > b else (b, a)
+        return high + math.log1p(math.exp(low - high))
+
+    def refresh(self):
+        now = time.time()
+        scores = {}
+        for weapon_id, timestamp, n in self.history.recent(now - self.window, now):
+            if n > 0 and weapon_id in valid_kit_id_set:
+                scores[weapon_id] = self.log_add(scores.get(weapon_id), self.log_weight(n, timestamp))
+        for (minute, weapon_id), n in self.history.unflushed():
+            if weapon_id in valid_kit_id_set:
+                scores[weapon_id] = self.log_add(scores.get(weapon_id), self.log_weight(n, minute + 30))
+        keys = SortedKeyList((-key, weapon_id) for weapon_id, key in scores.items())
+        with self.lock:
+            self.scores = scores
+            self.keys = keys
+            self.loaded_at = time.monotonic()
+
+    def ensure_fresh(self):
+        if self.loaded_at is None or time.monotonic() - self.loaded_at > self.ttl:
+            self.refresh()
+
+    def apply(self, increments, timestamp):
+        with self.lock:
+            if self.loaded_at is None:
+                return
+            for weapon_id, n in increments.items():
+                old_key = self.scores.get(weapon_id)
+                if old_key is not None:
+                    self.keys.remove((-old_key, weapon_id))
+                new_key = self.log_add(old_key, self.log_weight(n, timestamp))
+                self.keys.add((-new_key, weapon_id))
+                self.scores[weapon_id] = new_key
+
+    def score(self, key, now):
+        # 現在の時刻での減衰後のスコア
+        return math.exp(key - self.decay * (now - self.epoch))
+
+    def ordered_ids(self, allowed=None):
+        # スコアのあるキットをトレンド順に返す (allowed を渡すとその中のキットだけ)
+        self.ensure_fresh()
+        with self.lock:
+            keys = self.keys.slice(0, len(self.keys))
+        if allowed is None:
+            return [weapon_id for _, weapon_id in keys]
+        return [weapon_id for _, weapon_id in keys if weapon_id in allowed]
+
+    def page(self, offset, limit):
+        # [(weapon_id, 現在のスコア), ...] を返す
+        self.ensure_fresh()
+        now = time.time()
+        with self.lock:
+            keys = self.keys.slice(offset, offset + limit)
+        return [(weapon_id, self.score(-negative_key, now)) for negative_key, weapon_id in keys]
+
+
+vote_history = None
+trending_engine = None
+if app.config['VOTE_HISTORY_ENABLED']:
+    vote_history = VoteHistory(
+        app.config['VOTE_HISTORY_FLUSH_SECONDS'],
+        app.config['VOTE_HISTORY_MINUTE_RETENTION_HOURS'] * 3600,
+        app.config['VOTE_HISTORY_HOUR_RETENTION_DAYS'] * 86400,
+    )
+    trending_engine = TrendingEngine(
+        vote_history, app.config['TRENDING_HALF_LIFE_HOURS'] * 3600, app.config['TRENDING_REFRESH_SECONDS']
+    )
+    # プロセス終了時に残っている履歴を書き込む
+    atexit.register(vote_history.flush)
+
+
+def trending_kit_ids(kit_ids, start, end):
+    # 絞り込んだキットをトレンド順 (スコアのないキットはその後に種類順) に並べ、start から end までを返す
+    if trending_engine is None:
+        return list(kit_ids[start:end])
+    allowed = None if len(kit_ids) == len(valid_kit_ids) else set(kit_ids)
+    trending_ids = trending_engine.ordered_ids(allowed)
+    if end <= len(trending_ids):
+        return trending_ids[start:end]
+    trending_set = set(trending_ids)
+    rest = (i for i in kit_ids if i not in trending_set)
+    return trending_ids[start:end] + list(itertools.islice(
+        rest, max(0, start - len(trending_ids)), end - len(trending_ids)
+    ))
+
+
+# --- 集計 (/api/stats) ---
+class VoteStats:
+    # 有効なキットの並び (valid_kit_ids) に揃えた投票数のベクトルと、各キットのブキ種/メイン/サブ/スペシャルの
+    # 番号の配列を NumPy で持ち、bincount でグループごとの合計やクロス集計を求める
+    # NumPy は最初の /api/stats で読み込む (なければ ImportError になり、そのAPIだけ使えない)
+    def __init__(self, ttl):
+        import numpy as np
+
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.kit_ids = np.frombuffer(valid_kit_ids, dtype=np.uint16).astype(np.int64)
+        # キットID -> ベクトル上の位置 (除外キットは -1)
+        self.positions = np.full(num_combinations, -1, dtype=np.int64)
+        self.positions[self.kit_ids] = np.arange(len(self.kit_ids))
+
+        main_ids, rest = np.divmod(self.kit_ids, len(sub_weapons_list) * len(special_weapons_list))
+        sub_ids, special_ids = np.divmod(rest, len(special_weapons_list))
+        type_of_main = np.array([weapon_type_names.index(weapon['type']) for weapon in main_weapons_list])
+        self.dimensions = {
+            'type': (type_of_main[main_ids], weapon_type_names),
+            'main': (main_ids, tuple(weapon['name'] for weapon in main_weapons_list)),
+            'sub': (sub_ids, sub_weapon_names),
+            'special': (special_ids, special_weapon_names),
+        }
+        self.votes = np.zeros(len(self.kit_ids), dtype=np.int64)
+        self.loaded_at = None
+
+    def refresh(self):
+        import numpy as np
+
+        counts = fetch_vote_counts()
+        votes = np.zeros(len(self.kit_ids), dtype=np.int64)
+        if counts:
+            ids = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+            values = np.fromiter(counts.values(), dtype=np.int64, count=len(counts))
+            positions = self.positions[ids]
+            valid = positions >= 0
+            votes[positions[valid]] = values[valid]
+        with self.lock:
+            self.votes = votes
+            self.loaded_at = time.monotonic()
+
+    def ensure_fresh(self):
+        if self.loaded_at is None or time.monotonic() - self.loaded_at > self.ttl:
+            self.refresh()
+
+    def apply(self, new_counts):
+        with self.lock:
+            if self.loaded_at is None:
+                return
+            for weapon_id, vote_count in new_counts.items():
+                position = self.positions[weapon_id] if 0 <= weapon_id < num_combinations else -1
+                if position >= 0:
+                    self.votes[position] = vote_count
+
+    def _select(self, type_filter, sub_filter, special_filter):
+        # 一覧ページと同じ絞り込みで、対象キットのベクトル上の位置 (絞り込みなしならNone) を返す
+        import numpy as np
+
+        if type_filter == sub_filter == special_filter == 'all':
+            return None
+        kit_ids = filter_kit_ids(type_filter, sub_filter, special_filter)
+        return self.positions[np.frombuffer(kit_ids, dtype=np.uint16).astype(np.int64)]
+
+    def summary(self, group, by=None, type_filter='all', sub_filter='all', special_filter='all'):
+        # group ごとの投票数・シェア・キット数 (投票数の多い順)、by を指定すると group × by のクロス集計を返す
+        import numpy as np
+
+        self.ensure_fresh()
+        selected = self._select(type_filter, sub_filter, special_filter)
+        with self.lock:
+            votes = self.votes if selected is None else self.votes[selected]
+        group_ids, group_names = self.dimensions[group]
+        if selected is not None:
+            group_ids = group_ids[selected]
+
+        total_votes = int(votes.sum())
+        result = {'group': group, 'total_votes': total_votes, 'kit_count': int(len(votes))}
+        if by is None:
+            group_votes = np.bincount(group_ids, weights=votes, minlength=len(group_names)).astype(np.int64)
+            group_kits = np.bincount(group_ids, minlength=len(group_names))
+            order = np.lexsort((np.arange(len(group_names)), -group_votes))
+            result['rows'] = [
+                {
+                    'name': group_names[i],
+                    'votes': int(group_votes[i]),
+                    'share': round(float(group_votes[i]) / total_votes, 4) if total_votes else 0.0,
+                    'kits': int(group_kits[i]),
+                }
+                for i in order.tolist() if group_kits[i]
+            ]
+        else:
+            by_ids, by_names = self.dimensions[by]
+            if selected is not None:
+                by_ids = by_ids[selected]
+            cells = np.bincount(group_ids * len(by_names) + by_ids, weights=votes,
+                                minlength=len(group_names) * len(by_names))
+            result.update({
+                'by': by,
+                'rows': list(group_names),
+                'columns': list(by_names),
+                'counts': cells.astype(np.int64).reshape(len(group_names), len(by_names)).tolist(),
+            })
+        return result
+
+
+# None: まだ作っていない / False: NumPy がなく使えない
+vote_stats = None
+vote_stats_lock = threading.Lock()
+
+
+def get_vote_stats():
+    # 最初の呼び出しで VoteStats を作る (起動時に NumPy を読み込まないため)。使えなければ None
+    global vote_stats
+    with vote_stats_lock:
+        if vote_stats is None:
+            try:
+                vote_stats = VoteStats(app.config['STATS_REFRESH_SECONDS'])
+            except ImportError:
+                app.logger.warning("NumPy is not installed; /api/stats is disabled")
+                vote_stats = False
+    return vote_stats or None
+
+
+# --- レスポンスキャッシュ ---
+class ResponseCache:
+    # 正規化したクエリ引数ごとに描画済みのレスポンスをTTL付きのLRUで保持する
+    # キーに投票の世代番号を含めるので、投票があると古いエントリは使われなくなる
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.generation = 0
+
+    def bump_generation(self):
+        with self.lock:
+            self.generation += 1
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() - entry['stored_at'] > self.ttl:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key, body, mimetype):
+        entry = {
+            'body': body,
+            'mimetype': mimetype,
+            'etag': hashlib.sha1(body).hexdigest(),
+            'last_modified': datetime.now(timezone.utc),
+            'stored_at': time.monotonic(),
+        }
+        if self.ttl > 0:
+            with self.lock:
+                self.entries[key] = entry
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+        return entry
+
+
+response_cache = ResponseCache(app.config['RESPONSE_CACHE_TTL'], app.config['RESPONSE_CACHE_SIZE'])
+
+
+def cached_response(arg_defaults):
+    # arg_defaults ({引数名: 既定値}) で正規化したクエリ引数をキーにレスポンスをキャッシュし、
+    # 強いETagとエッジ向けの Cache-Control を付ける
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(**kwargs):
+            normalized_args = tuple(
+                (name, request.args.get(name, default, type=type(default)))
+                for name, default in arg_defaults.items()
+            )
+            key = (request.endpoint, normalized_args, tuple(sorted(kwargs.items())), response_cache.generation)
+
+            entry = response_cache.get(key)
+            if entry is None:
+                response = make_response(view(**kwargs))
+                if response.status_code != 200:
+                    return response
+                entry = response_cache.set(key, response.get_data(), response.mimetype)
+
+            response = app.response_class(entry['body'], mimetype=entry['mimetype'])
+            response.set_etag(entry['etag'])
+            response.last_modified = entry['last_modified']
+            response.headers['Cache-Control'] = (
+                f"public, max-age=0, s-maxage={app.config['CDN_CACHE_MAX_AGE']}, "
+                f"stale-while-revalidate={app.config['CDN_STALE_WHILE_REVALIDATE']}"
+            )
+            return response.make_conditional(request)
+        return wrapper
+    return decorator
+
+
+# --- 一覧ページのタイル ---
+class TileFragmentCache:
+    # キットごとに _weapon_tile.html のマクロで描画したHTMLを、投票数の前後で分けてLRUで保持する
+    # 投票数以外はキットごとに変わらないので、ページの描画は断片をつなげて投票数を挟むだけになる
+    placeholder = '\x00vote_count\x00'
+
+    def __init__(self, template_name, max_size):
+        self.template_name = template_name
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.fragments = OrderedDict()
+
+    def _render(self, kit_id):
+        tile = app.jinja_env.get_template(self.template_name).module.weapon_tile
+        html = str(tile(Kit(kit_id), Markup(self.placeholder)))
+        before, _, after = html.partition(self.placeholder)
+        return before, after
+
+    def fragment(self, kit_id):
+        with self.lock:
+            fragment = self.fragments.get(kit_id)
+            if fragment is not None:
+                self.fragments.move_to_end(kit_id)
+                return fragment
+        fragment = self._render(kit_id)
+        with self.lock:
+            self.fragments[kit_id] = fragment
+            while len(self.fragments) > self.max_size:
+                self.fragments.popitem(last=False)
+        return fragment
+
+    def render(self, rows):
+        # [(kit_id, 投票数), ...] のタイルをつなげたHTMLを返す
+        tiles = []
+        for kit_id, vote_count in rows:
+            before, after = self.fragment(kit_id)
+            tiles.append(f'{before}{vote_count}{after}')
+        return Markup('\n        '.join(tiles))
+
+
+tile_cache = TileFragmentCache('_weapon_tile.html', app.config['TILE_CACHE_SIZE'])
+
+
+# --- 投票数の変更履歴 ---
+class VoteChangeLog:
+    # 直近の投票数の変更を (バージョン, weapon_id, 新しい投票数) で保持し、差分の取得と待ち合わせに使う
+    # 履歴はプロセスごとなので、カーソルにはプロセス固有のIDを含め、別のプロセスのカーソルは追えないものとして扱う
+    def __init__(self, max_entries):
+        self.log_id = os.urandom(4).hex()
+        self.condition = threading.Condition()
+        self.entries = deque(maxlen=max_entries)
+        self.version = 0
+
+    def cursor(self, version):
+        return f'{self.log_id}.{version}'
+
+    def parse_cursor(self, cursor):
+        # このプロセスの履歴で追えるカーソルならバージョン番号を、追えなければNoneを返す
+        log_id, _, version = (cursor or '').partition('.')
+        if log_id != self.log_id or not version.isdigit():
+            return None
+        version = int(version)
+        with self.condition:
+            if version > self.version:
+                return None
+            if self.entries and version < self.entries[0][0] - 1:
+                return None
+        return version
+
+    def record(self, new_counts):
+        with self.condition:
+            for weapon_id, vote_count in new_counts.items():
+                self.version += 1
+                self.entries.append((self.version, weapon_id, vote_count))
+            self.condition.notify_all()
+
+    def changes_since(self, version, weapon_ids=None):
+        # version より後の変更を {weapon_id: 最新の投票数} と現在のバージョンで返す
+        counts = {}
+        with self.condition:
+            for entry_version, weapon_id, vote_count in reversed(self.entries):
+                if entry_version <= version:
+                    break
+                if weapon_ids is None or weapon_id in weapon_ids:
+                    counts.setdefault(weapon_id, vote_count)
+            return counts, self.version
+
+    def wait(self, version, timeout):
+        with self.condition:
+            self.condition.wait_for(lambda: self.version > version, timeout)
+
+
+vote_change_log = VoteChangeLog(app.config['VOTE_CHANGE_LOG_SIZE'])
+
+
+def after_votes_applied(new_counts):
+    # 投票数が変わったとき ({weapon_id: 新しい投票数}) にメモリ上の集計へ反映する
+    if ranking_engine is not None:
+        ranking_engine.apply(new_counts)
+    if vote_stats:
+        vote_stats.apply(new_counts)
+    response_cache.bump_generation()
+    vote_change_log.record(new_counts)
+
+
+vote_buffer = None
+if app.config['VOTE_WRITE_MODE'] == 'buffered':
+    vote_buffer = VoteBuffer(
+        app.config['VOTE_BUFFER_FLUSH_MS'] / 1000,
+        app.config['VOTE_BUFFER_MAX_PENDING'],
+        app.config['VOTE_BUFFER_JOURNAL'] or None,
+    )
+    # プロセス終了時に残っている票を書き込む
+    atexit.register(vote_buffer.flush)
+
+
+# --- 1日の投票数の上限 ---
+class DailyVoteQuota:
+    # クライアントごとの1日の投票数を共有ストア (vote_quota テーブル) でアトミックに数える
+    # 手前にプロセス内のトークンバケットと「本日分を使い切った」キャッシュを置き、
+    # 連打や上限に達したクライアントからのリクエストは共有ストアに問い合わせずに拒否する
+    # defer_commit=True (カウンタがメインのDBにあり、票をその場で書き込む場合) では加算をコミットせず、
+    # 票の書き込みと同じトランザクションでコミットする (投票1回につき接続とコミットは1回)
+    def __init__(self, daily_limit, burst, refill_per_second, utc_offset_hours, max_clients=10000, defer_commit=False):
+        self.daily_limit = daily_limit
+        self.burst = burst
+        self.refill_per_second = refill_per_second
+        self.tz = timezone(timedelta(hours=utc_offset_hours))
+        self.max_clients = max_clients
+        self.lock = threading.Lock()
+        self.buckets = OrderedDict()
+        self.exhausted = OrderedDict()
+        self.defer_commit = defer_commit
+
+    def today(self):
+        return datetime.now(self.tz).date()
+
+    @staticmethod
+    def client_key(client):
+        return hashlib.sha256(f"{app.config['SECRET_KEY']}:{client}".encode()).hexdigest()[:32]
+
+    def _remember(self, mapping, key, value):
+        mapping[key] = value
+        mapping.move_to_end(key)
+        while len(mapping) > self.max_clients:
+            mapping.popitem(last=False)
+
+    def _take_tokens(self, key, n):
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated_at = self.buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated_at) * self.refill_per_second)
+            allowed = tokens >= n
+            if allowed:
+                tokens -= n
+            self._remember(self.buckets, key, (tokens, now))
+        return allowed
+
+    def consume(self, client, n):
+        # n 票分を使う。('ok' / 'rate_limited' / 'exceeded', 本日の残り票数 (不明ならNone)) を返す
+        key = self.client_key(client)
+        day = self.today()
+
+        with self.lock:
+            if self.exhausted.get(key) == day:
+                return 'exceeded', 0
+        if not self._take_tokens(key, n):
+            return 'rate_limited', None
+        if n > self.daily_limit:
+            return 'exceeded', None
+
+        table = VoteQuota.__table__
+        engine = db.engines[VoteQuota.__bind_key__]
+        stmt = dialect_insert(table, engine).values(client_key=key, day=day, vote_count=n)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.client_key, table.c.day],
+            set_={'vote_count': table.c.vote_count + stmt.excluded.vote_count},
+            where=table.c.vote_count + stmt.excluded.vote_count <= self.daily_limit,
+        ).returning(table.c.vote_count)
+        try:
+            used = db.session.execute(stmt).scalar()
+        except (OperationalError, ProgrammingError):
+            # 別のDBにしたカウンタ用のテーブルがまだなければ作ってやり直す
+            db.session.rollback()
+            table.create(engine, checkfirst=True)
+            used = db.session.execute(stmt).scalar()
+        if not self.defer_commit:
+            db.session.commit()
+
+        if used is None:
+            # 上限を超えるので加算されなかった
+            used = db.session.query(VoteQuota.vote_count).filter_by(client_key=key, day=day).scalar() or 0
+            status = 'exceeded'
+        else:
+            status = 'ok'
+        if used >= self.daily_limit:
+            with self.lock:
+                self._remember(self.exhausted, key, day)
+        return status, self.daily_limit - used
+
+    def refund(self, client, n, rolled_back=False):
+        # 投票の書き込みに失敗したときに使った分を戻す
+        # (rolled_back=True なら加算は票と一緒にロールバック済みなので、使い切ったというキャッシュだけを消す)
+        key = self.client_key(client)
+        day = self.today()
+        with self.lock:
+            self.exhausted.pop(key, None)
+        if rolled_back:
+            return
+        table = VoteQuota.__table__
+        db.session.execute(
+            table.update()
+            .where(table.c.client_key == key, table.c.day == day)
+            .values(vote_count=table.c.vote_count - n)
+        )
+        db.session.commit()
+
+    def prune(self):
+        # 前日以前の行を削除し、削除した行数を返す (/vote の中では行わず、flask prune-vote-quota で実行する)
+        result = db.session.execute(VoteQuota.__table__.delete().where(VoteQuota.__table__.c.day < self.today()))
+        db.session.commit()
+        return result.rowcount
+
+
+vote_quota = None
+if app.config['VOTE_QUOTA_ENABLED']:
+    vote_quota = DailyVoteQuota(
+        app.config['MAX_VOTES_PER_DAY'],
+        app.config['VOTE_BURST'],
+        app.config['VOTE_REFILL_PER_SECOND'],
+        app.config['VOTE_QUOTA_UTC_OFFSET_HOURS'],
+        defer_commit=VoteQuota.__bind_key__ is None and app.config['VOTE_WRITE_MODE'] == 'direct',
+    )
+
+
+def record_votes(increments):
+    # {weapon_id: n} の票を書き込み (またはバッファに積み)、新しい {weapon_id: 投票数} を返す
+    if vote_buffer is not None:
+        new_counts = {weapon_id: vote_buffer.add(weapon_id, n) for weapon_id, n in increments.items()}
+    else:
+        new_counts = apply_vote_increments(increments)
+    after_votes_applied(new_counts)
+    if vote_history is not None:
+        now = time.time()
+        trending_engine.apply(increments, now)
+        if not vote_history.write_through:
+            # 書き込みはバックグラウンドでまとめて行う (投票ごとの場合は apply_vote_increments で書いている)
+            vote_history.add(increments, now)
+    return new_counts
+
+
+def run_shard_compaction(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            with app.app_context():
+                compact_vote_shards()
+        except Exception:
+            app.logger.exception("Failed to compact vote shards")
+
+
+if app.config['VOTE_STORAGE'] == 'sharded' and app.config['VOTE_SHARD_COMPACT_INTERVAL'] > 0:
+    threading.Thread(
+        target=run_shard_compaction, args=(app.config['VOTE_SHARD_COMPACT_INTERVAL'],),
+        name='vote-shard-compaction', daemon=True,
+    ).start()
+
+
+@app.cli.command('compact-shards')
+def compact_shards_command():
+    # シャードの票をvotesへ集約する (VOTE_STORAGE を sharded から single に戻す前にも実行する)
+    with app.app_context():
+        db.create_all()
+        moved = compact_vote_shards()
+    print(f"Compacted {moved} votes from vote_shards into votes.")
+
+
+@app.cli.command('prune-vote-quota')
+def prune_vote_quota_command():
+    # 前日以前の投票回数のカウンタを削除する (/vote では行わないので定期的に実行する)
+    if vote_quota is None:
+        print("Vote quota is disabled.")
+        return
+    with app.app_context():
+        removed = vote_quota.prune()
+    print(f"Removed {removed} expired vote quota rows.")
+
+
+@app.cli.command('prune-vote-history')
+def prune_vote_history_command():
+    # 保持期間を過ぎた履歴のバケットを削除する
+    # (バックグラウンドで書き込む設定では書き込みのついでに1時間ごとに行う。VOTE_HISTORY_FLUSH_SECONDS=0 では
+    # バックグラウンドの処理がないので、このコマンドを定期的に実行する)
+    if vote_history is None:
+        print("Vote history is disabled.")
+        return
+    with app.app_context():
+        db.create_all()
+        removed = vote_history.prune(time.time())
+    print(f"Removed {removed} expired vote history buckets.")
+
+
+# --- エクスポート ---
+# ランキング (投票数順) またはスナップショット (ID順) の全件を、サーバー側カーソルで少しずつ読みながら
+# NDJSON / CSV / 列形式 (IDと投票数の配列のチャンク) で出力する。メモリ使用量は件数によらず一定
+EXPORT_CHUNK_ROWS = 1000
+EXPORT_FORMATS = {
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'csv': ('text/csv; charset=utf-8', 'csv'),
+    'columnar': ('application/x-ndjson', 'ndjson'),
+}
+
+
+def export_rows(kind):
+    # (順位, weapon_id, 投票数) を順に返す。kind='snapshot' はID順 (順位は None)
+    totals = vote_totals()
+    query = db.session.query(totals.c.weapon_id, totals.c.vote_count) \
+        .filter(totals.c.weapon_id.notin_(excluded_kit_ids))
+    if kind == 'ranking':
+        query = query.order_by(totals.c.vote_count.desc(), totals.c.weapon_id.asc())
+    else:
+        query = query.order_by(totals.c.weapon_id.asc())
+    for position, (weapon_id, vote_count) in enumerate(query.yield_per(EXPORT_CHUNK_ROWS), 1):
+        yield (position if kind == 'ranking' else None), weapon_id, vote_count
+
+
+def export_chunks(kind, export_format):
+    # 出力する文字列をチャンクごとに返す
+    rows = export_rows(kind)
+
+    if export_format == 'columnar':
+        # 1行目はメタデータ、以降は {"ids": [...], "vote_counts": [...]} の行 (ブキの情報は catalog を参照)
+        yield json.dumps({
+            'kind': kind, 'snapshot_at': datetime.now(timezone.utc).isoformat(), 'catalog': '/api/export/catalog',
+        }) + '\n'
+        while True:
+            chunk = list(itertools.islice(rows, EXPORT_CHUNK_ROWS))
+            if not chunk:
+                break
+            yield json.dumps({
+                'ids': [weapon_id for _, weapon_id, _ in chunk],
+                'vote_counts': [vote_count for _, _, vote_count in chunk],
+            }) + '\n'
+        return
+
+    if export_format == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator='\n')
+        writer.writerow((['rank'] if kind == 'ranking' else []) + ['id', 'main', 'sub', 'special', 'vote_count'])
+    while True:
+        chunk = list(itertools.islice(rows, EXPORT_CHUNK_ROWS))
+        if not chunk:
+            break
+        lines = []
+        for rank, weapon_id, vote_count in chunk:
+            main, sub, special = kit_parts(weapon_id)
+            if export_format == 'csv':
+                writer.writerow(([rank] if kind == 'ranking' else []) +
+                                [weapon_id, main['name'], sub['name'], special['name'], vote_count])
+            else:
+                row = {'id': weapon_id, 'main': main['name'], 'sub': sub['name'],
+                       'special': special['name'], 'vote_count': vote_count}
+                if kind == 'ranking':
+                    row = dict(rank=rank, **row)
+                lines.append(json.dumps(row, ensure_ascii=False) + '\n')
+        if export_format == 'csv':
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        else:
+            yield ''.join(lines)
+
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 で gzip 形式
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_catalog():
+    # 列形式のエクスポートと組み合わせて使うブキの一覧と、キットごとのメイン/サブ/スペシャルの番号
+    kit_ids = list(valid_kit_ids)
+    parts = [kit_attributes(kit_id) for kit_id in kit_ids]
+    return {
+        'mains': [{'name': weapon['name'], 'type': weapon['type'], 'image_url': url}
+                  for weapon, url in zip(main_weapons_list, main_image_urls)],
+        'subs': [{'name': weapon['name'], 'image_url': url} for weapon, url in zip(sub_weapons_list, sub_image_urls)],
+        'specials': [{'name': weapon['name'], 'image_url': url}
+                     for weapon, url in zip(special_weapons_list, special_image_urls)],
+        'kits': {
+            'ids': kit_ids,
+            'main': [main_id for main_id, _, _ in parts],
+            'sub': [sub_id for _, sub_id, _ in parts],
+            'special': [special_id for _, _, special_id in parts],
+        },
+    }
+
+
+@app.cli.command('export')
+@click.option('--kind', type=click.Choice(['ranking', 'snapshot', 'catalog']), default='ranking')
+@click.option('--format', 'export_format', type=click.Choice(list(EXPORT_FORMATS)), default='ndjson')
+@click.option('--output', type=click.Path(dir_okay=False), help='Output file (default: stdout).')
+@click.option('--gzip', 'use_gzip', is_flag=True, help='Compress the output with gzip.')
+def export_command(kind, export_format, output, use_gzip):
+    # 例: flask export --kind ranking --format csv --gzip --output ranking.csv.gz
+    with app.app_context():
+        if kind == 'catalog':
+            chunks = iter([json.dumps(export_catalog(), ensure_ascii=False) + '\n'])
+        else:
+            chunks = export_chunks(kind, export_format)
+        if use_gzip:
+            data = gzip_chunks(chunks)
+        else:
+            data = (chunk.encode('utf-8') for chunk in chunks)
+
+        stream = open(output, 'wb') if output else sys.stdout.buffer
+        try:
+            for block in data:
+                stream.write(block)
+        finally:
+            if output:
+                stream.close()
+            else:
+                stream.flush()
+
 
 # --- ルーティング ---
 
 @app.route('/')
+@cached_response({'page': 1, 'type': 'all', 'sub': 'all', 'special': 'all', 'sort': 'default'})
 def index():
     # (フィルター/ソート条件の取得は変更なし)
     page = request.args.get('page', 1, type=int)
@@ -390,50 +2799,25 @@ def index():
     
     current_filters = { 'type': type_filter, 'sub': sub_filter, 'special': special_filter, 'sort': sort_order }
 
-    # SQLAlchemyで投票数を取得
-    votes_rows = db.session.query(Votes).all()
-    votes_dict = {row.weapon_id: row.vote_count for row in votes_rows}
-
-    # (絞り込み、ソート、ページ分けのロジックはほぼ変更なし)
-    filtered_weapons = []
-    for i, (main, sub, special) in enumerate(all_combinations):
-        current_kit = (main.get('name'), sub.get('name'), special.get('name'))
-        if current_kit in excluded_kits_set:
-            continue
-        if (type_filter == 'all' or main.get('type') == type_filter) and \
-           (sub_filter == 'all' or sub.get('name') == sub_filter) and \
-           (special_filter == 'all' or special.get('name') == special_filter):
-            filtered_weapons.append({
-                "id": i, "main": main, "sub": sub, "special": special,
-                "vote_count": votes_dict.get(i, 0)
-            })
-    
-    if sort_order == 'votes_desc':
-        filtered_weapons.sort(key=lambda x: x['vote_count'], reverse=True)
-    elif sort_order == 'votes_asc':
-        filtered_weapons.sort(key=lambda x: x['vote_count'])
-
     per_page = 100
     start = (page - 1) * per_page
     end = start + per_page
-    paginated_weapons = filtered_weapons[start:end]
-    total_pages = math.ceil(len(filtered_weapons) / per_page)
-
-    # (プルダウンメニュー用のリスト作成は変更なし)
-    weapon_types = []
-    for weapon in main_weapons_list:
-        if weapon.get("type") not in weapon_types:
-            weapon_types.append(weapon.get("type"))
-            
-    sub_weapon_names = [sub.get('name') for sub in sub_weapons_list]
-    special_weapon_names = [special.get('name') for special in special_weapons_list]
-    sub_weapon_names = [sub.get('name') for sub in sub_weapons_list]
-    special_weapon_names = [special.get('name') for special in special_weapons_list]
+
+    with timed_phase('grid'):
+        # トレンド順はメモリ上のスコアで並べるので、sql モードでもインデックスを使う
+        if app.config['GRID_QUERY_MODE'] == 'sql' and sort_order != 'trending':
+            page_rows, total_count = grid_page_from_sql(type_filter, sub_filter, special_filter, sort_order, start, end)
+        else:
+            page_rows, total_count = grid_page_from_index(type_filter, sub_filter, special_filter, sort_order, start, end)
+    total_pages = math.ceil(total_count / per_page)
+
+    with timed_phase('tiles'):
+        weapon_tiles = tile_cache.render(page_rows)
 
     return render_template(
         'index.html',
-        weapons=paginated_weapons,
-        weapon_types=weapon_types,
+        weapon_tiles=weapon_tiles,
+        weapon_types=weapon_type_names,
         sub_weapons=sub_weapon_names,
         special_weapons=special_weapon_names,
         current_page=page,
@@ -442,6 +2826,44 @@ def index():
     )
 
 
+@app.route('/api/csrf_token')
+def csrf_token():
+    # 一覧ページはキャッシュして共有するため、CSRFトークンはページに埋め込まず個別に返す
+    response = jsonify({'csrf_token': generate_csrf()})
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+def consume_vote_quota(n):
+    # n 票分を使えるか確認し、(拒否するときのレスポンス (許可ならNone), 本日の残り票数) を返す
+    if vote_quota is None:
+        return None, None
+    try:
+        status, remaining = vote_quota.consume(get_real_ip(), n)
+    except Exception:
+        # カウンタのストアに障害があっても投票自体は止めない
+        db.session.rollback()
+        app.logger.exception("Failed to check the daily vote quota")
+        return None, None
+
+    if status == 'rate_limited':
+        return (jsonify({'success': False, 'error': 'Too many requests'}), 429), remaining
+    if status == 'exceeded':
+        return (jsonify({'success': False, 'error': 'Daily vote limit exceeded', 'remaining_votes': remaining}), 429), remaining
+    return None, remaining
+
+
+def refund_vote_quota(n, rolled_back=False):
+    # rolled_back=True は票の書き込みをロールバックした後 (同じトランザクションで数えた分は既に戻っている)
+    if vote_quota is None:
+        return
+    try:
+        vote_quota.refund(get_real_ip(), n, rolled_back=rolled_back and vote_quota.defer_commit)
+    except Exception:
+        db.session.rollback()
+        app.logger.exception("Failed to refund the daily vote quota")
+
+
 @app.route('/vote', methods=['POST'])
 @limiter.limit("30 per minute")
 def vote():
@@ -451,45 +2873,279 @@ def vote():
     if weapon_id is None:
         return jsonify({'success': False, 'error': 'Weapon ID is missing'}), 400
 
+    if type(weapon_id) is not int or weapon_id not in valid_kit_id_set:
+        return jsonify({'success': False, 'error': 'Weapon ID not found'}), 404
+
+    with timed_phase('quota'):
+        rejection, remaining = consume_vote_quota(1)
+    if rejection is not None:
+        return rejection
+
     try:
-        # SQLAlchemyで投票数を更新
-        vote_entry = db.session.get(Votes, weapon_id)
-        if vote_entry:
-            vote_entry.vote_count += 1
-            db.session.commit()
-            return jsonify({'success': True, 'new_vote_count': vote_entry.vote_count})
-        else:
+        # UPDATE ... SET vote_count = vote_count + 1 でアトミックに加算
+        with timed_phase('write'):
+            new_vote_count = record_votes({weapon_id: 1}).get(weapon_id)
+        if new_vote_count is None:
+            # 票が入らなかった (書き込みはロールバック済み) ので消費した回数を戻す
+            refund_vote_quota(1, rolled_back=True)
             return jsonify({'success': False, 'error': 'Weapon ID not found'}), 404
+        return jsonify({'success': True, 'new_vote_count': new_vote_count, 'remaining_votes': remaining})
     except Exception as e:
         db.session.rollback()
+        refund_vote_quota(1, rolled_back=True)
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
+@app.route('/vote/batch', methods=['POST'])
+@limiter.limit("30 per minute")
+def vote_batch():
+    # {"votes": [{"weapon_id": 1, "n": 2}, ...]} をまとめて1トランザクションで加算する
+    data = request.get_json(silent=True) or {}
+    entries = data.get('votes')
+
+    if not isinstance(entries, list) or not entries:
+        return jsonify({'success': False, 'error': 'Votes are missing'}), 400
+
+    increments = Counter()
+    for entry in entries:
+        if not isinstance(entry, dict):
+            return jsonify({'success': False, 'error': 'Invalid vote entry'}), 400
+        weapon_id = entry.get('weapon_id')
+        n = entry.get('n', 1)
+        if type(weapon_id) is not int or weapon_id not in valid_kit_id_set:
+            return jsonify({'success': False, 'error': 'Weapon ID not found'}), 404
+        if type(n) is not int or n < 1:
+            return jsonify({'success': False, 'error': 'Invalid vote count'}), 400
+        increments[weapon_id] += n
+
+    total = sum(increments.values())
+    if total > app.config['MAX_VOTES_PER_DAY']:
+        return jsonify({'success': False, 'error': 'Daily vote limit exceeded'}), 429
+
+    with timed_phase('quota'):
+        rejection, remaining = consume_vote_quota(total)
+    if rejection is not None:
+        return rejection
+
+    try:
+        with timed_phase('write'):
+            new_counts = record_votes(increments)
+        # 行がなく票が入らなかった分は消費した回数を戻す
+        missing = sum(n for weapon_id, n in increments.items() if weapon_id not in new_counts)
+        if missing:
+            refund_vote_quota(missing)
+            if remaining is not None:
+                remaining += missing
+        return jsonify({'success': True, 'new_vote_counts': new_counts, 'remaining_votes': remaining})
+    except Exception as e:
+        db.session.rollback()
+        refund_vote_quota(total, rolled_back=True)
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
 @app.route('/ranking')
 def ranking():
-    return render_template('ranking.html')
+    return render_template('ranking.html', ranking_stream_enabled=app.config['RANKING_STREAM_ENABLED'])
 
 
 @app.route('/api/ranking_data')
+@cached_response({'offset': 0, 'after': '', 'view': 'votes'})
 def ranking_data():
     offset = request.args.get('offset', 0, type=int)
     limit = 100
 
-    # SQLAlchemyでランキングデータを取得
-    votes_rows = db.session.query(Votes).order_by(Votes.vote_count.desc(), Votes.weapon_id.asc()).limit(limit).offset(offset).all()
-    
+    # view=trending なら最近の投票の勢い (減衰付きスコア) の順で返す
+    if request.args.get('view') == 'trending':
+        if trending_engine is None:
+            return jsonify({'success': False, 'error': 'Vote history is disabled'}), 404
+        with timed_phase('ranking'):
+            page_rows = trending_engine.page(max(offset, 0), limit)
+            vote_counts = fetch_vote_counts([weapon_id for weapon_id, _ in page_rows]) if page_rows else {}
+
+        trending_results = []
+        for weapon_id, score in page_rows:
+            kit = Kit(weapon_id, vote_counts.get(weapon_id, 0))
+            trending_results.append({
+                "id": weapon_id, "main": kit.main, "sub": kit.sub, "special": kit.special,
+                "main_image_url": kit.main_image_url, "sub_image_url": kit.sub_image_url,
+                "special_image_url": kit.special_image_url,
+                "vote_count": kit.vote_count, "trend_score": round(score, 3)
+            })
+        return jsonify(trending_results)
+
+    # after=<投票数>:<weapon_id> が指定されたらキーセット (カーソル) でページを取得
+    after = None
+    if request.args.get('after'):
+        try:
+            after_count, after_id = (int(value) for value in request.args['after'].split(':'))
+        except ValueError:
+            return jsonify({'success': False, 'error': 'Invalid cursor'}), 400
+        after = (after_count, after_id)
+
+    with timed_phase('ranking'):
+        page_rows = ranking_page(max(offset, 0), limit, after)
+
     ranking_results = []
-    for row in votes_rows:
-        weapon_id = row.weapon_id
-        main, sub, special = all_combinations[weapon_id]
+    for weapon_id, vote_count in page_rows:
+        kit = Kit(weapon_id, vote_count)
         ranking_results.append({
-            "main": main, "sub": sub, "special": special,
-            "vote_count": row.vote_count
+            "id": weapon_id, "main": kit.main, "sub": kit.sub, "special": kit.special,
+            "main_image_url": kit.main_image_url, "sub_image_url": kit.sub_image_url,
+            "special_image_url": kit.special_image_url,
+            "vote_count": vote_count
         })
 
     return jsonify(ranking_results)
 
 
+@app.route('/api/rank/<int:weapon_id>')
+@cached_response({})
+def weapon_rank(weapon_id):
+    position = ranking_position(weapon_id)
+    if position is None:
+        return jsonify({'success': False, 'error': 'Weapon ID not found'}), 404
+    rank, vote_count = position
+    return jsonify({'success': True, 'weapon_id': weapon_id, 'rank': rank, 'vote_count': vote_count})
+
+
+@app.route('/api/stats')
+@cached_response({'group': 'type', 'by': '', 'type': 'all', 'sub': 'all', 'special': 'all'})
+def stats():
+    # ブキ種/メイン/サブ/スペシャルごとの投票数の集計 (一覧ページと同じ type/sub/special で絞り込める)
+    #   /api/stats?group=sub                 サブごとの合計とシェア
+    #   /api/stats?group=sub&by=special      サブ × スペシャルのクロス集計
+    stats_engine = get_vote_stats()
+    if stats_engine is None:
+        return jsonify({'success': False, 'error': 'Statistics are not available'}), 503
+
+    group = request.args.get('group', 'type')
+    by = request.args.get('by') or None
+    if group not in stats_engine.dimensions or (by is not None and (by not in stats_engine.dimensions or by == group)):
+        return jsonify({'success': False, 'error': 'Invalid group'}), 400
+
+    with timed_phase('stats'):
+        result = stats_engine.summary(
+            group, by,
+            request.args.get('type', 'all'), request.args.get('sub', 'all'), request.args.get('special', 'all'),
+        )
+    return jsonify(dict(result, success=True))
+
+
+@app.route('/api/export')
+@limiter.limit("10 per minute")
+def export():
+    # /api/export?kind=ranking|snapshot&format=ndjson|csv|columnar&gzip=1
+    kind = request.args.get('kind', 'ranking')
+    export_format = request.args.get('format', 'ndjson')
+    if kind not in ('ranking', 'snapshot') or export_format not in EXPORT_FORMATS:
+        return jsonify({'success': False, 'error': 'Invalid export options'}), 400
+
+    mimetype, extension = EXPORT_FORMATS[export_format]
+    filename = f"{kind}-{datetime.now(timezone.utc):%Y%m%d%H%M%S}.{extension}"
+    headers = {'Cache-Control': 'no-store', 'Content-Disposition': f'attachment; filename="{filename}"'}
+
+    chunks = export_chunks(kind, export_format)
+    if request.args.get('gzip') == '1' and 'gzip' in request.headers.get('Accept-Encoding', ''):
+        headers.update({'Content-Encoding': 'gzip', 'Vary': 'Accept-Encoding'})
+        body = gzip_chunks(chunks)
+    else:
+        body = chunks
+    return Response(stream_with_context(body), mimetype=mimetype, headers=headers)
+
+
+@app.route('/api/export/catalog')
+@cached_response({})
+def export_catalog_view():
+    return jsonify(export_catalog())
+
+
+def parse_weapon_ids(value):
+    # "1,2,3" 形式のID一覧を正規のキットIDの集合にする (空ならNone)
+    if not value:
+        return None
+    weapon_ids = {int(weapon_id) for weapon_id in value.split(',') if weapon_id}
+    if len(weapon_ids) > app.config['VOTE_DELTA_MAX_IDS']:
+        raise ValueError('Too many weapon IDs')
+    return weapon_ids & valid_kit_id_set
+
+
+@app.route('/api/vote_deltas')
+@limiter.limit("30 per minute")
+def vote_deltas():
+    # since 以降に変わった投票数を ids のブキについて返す
+    # (RANKING_STREAM_ENABLED なら wait 秒まで変更を待つロングポーリングも可)
+    try:
+        weapon_ids = parse_weapon_ids(request.args.get('ids', ''))
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Invalid weapon IDs'}), 400
+
+    version = vote_change_log.parse_cursor(request.args.get('since'))
+    if version is None:
+        # 初回または追えないカーソルの場合は、現在の投票数をそのまま返して同期し直す
+        current = vote_change_log.version
+        counts = fetch_vote_counts(weapon_ids) if weapon_ids else {}
+        reset = True
+    else:
+        wait = min(request.args.get('wait', 0, type=float), app.config['VOTE_DELTA_MAX_WAIT'])
+        if wait > 0 and app.config['RANKING_STREAM_ENABLED']:
+            vote_change_log.wait(version, wait)
+        counts, current = vote_change_log.changes_since(version, weapon_ids)
+        reset = False
+
+    response = jsonify({
+        'success': True, 'version': vote_change_log.cursor(current), 'reset': reset, 'counts': counts
+    })
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+@app.route('/api/ranking_stream')
+def ranking_stream():
+    # 投票数の変更を Server-Sent Events で送る。VOTE_STREAM_MAX_SECONDS で接続を閉じ、
+    # ブラウザは Last-Event-ID を付けて再接続するので続きから受け取れる
+    if not app.config['RANKING_STREAM_ENABLED']:
+        return jsonify({'success': False, 'error': 'Not found'}), 404
+    try:
+        weapon_ids = parse_weapon_ids(request.args.get('ids', ''))
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Invalid weapon IDs'}), 400
+
+    version = vote_change_log.parse_cursor(request.headers.get('Last-Event-ID') or request.args.get('since'))
+    if version is None:
+        version = vote_change_log.version
+    max_seconds = app.config['VOTE_STREAM_MAX_SECONDS']
+
+    def generate(version):
+        deadline = time.monotonic() + max_seconds
+        yield 'retry: 3000\n\n'
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            vote_change_log.wait(version, min(15, remaining))
+            counts, version = vote_change_log.changes_since(version, weapon_ids)
+            if counts:
+                data = json.dumps({'counts': counts})
+                yield f'id: {vote_change_log.cursor(version)}\nevent: votes\ndata: {data}\n\n'
+            else:
+                yield ': keepalive\n\n'
+
+    return Response(generate(version), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-store', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/metrics')
+def metrics():
+    if not app.config['METRICS_ENABLED']:
+        return jsonify({'success': False, 'error': 'Not found'}), 404
+    token = app.config['METRICS_TOKEN']
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return jsonify({'success': False, 'error': 'Unauthorized'}), 401
+    response = app.response_class(request_metrics.exposition(), mimetype='text/plain; version=0.0.4')
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
 @app.route('/about')
 def about():
     return render_template('about.html')
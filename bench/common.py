@@ -0,0 +1,111 @@
+# ベンチマーク共通の処理 (アプリの読み込み、集計、結果のJSON出力とベースラインとの比較)
+import os
+import sys
+import json
+import platform
+import subprocess
+import tempfile
+import warnings
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_app(database_url=None, env=None):
+    # 環境変数を設定してから app を読み込む (設定は読み込み時に決まるため)
+    if database_url is None:
+        database_url = 'sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='splat-bench-'), 'bench.db')
+    os.environ['POSTGRES_URL'] = database_url
+    os.environ.setdefault('VOTE_QUOTA_ENABLED', '0')
+    os.environ.setdefault('SERVER_TIMING_ENABLED', '0')
+    for key, value in (env or {}).items():
+        os.environ[key] = str(value)
+
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    warnings.filterwarnings('ignore')
+    import app as vote_app
+
+    vote_app.app.config['WTF_CSRF_ENABLED'] = False
+    vote_app.limiter.enabled = False
+    vote_app.init_db_postgres()
+    return vote_app
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(seconds):
+    # レイテンシ (秒) の一覧をミリ秒の統計にまとめる
+    values = sorted(seconds)
+    if not values:
+        return {'count': 0}
+    return {
+        'count': len(values),
+        'mean_ms': sum(values) / len(values) * 1000,
+        'p50_ms': percentile(values, 0.50) * 1000,
+        'p95_ms': percentile(values, 0.95) * 1000,
+        'p99_ms': percentile(values, 0.99) * 1000,
+        'max_ms': values[-1] * 1000,
+    }
+
+
+def run_metadata(vote_app, args):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ''
+    config = vote_app.app.config
+    with vote_app.app.app_context():
+        database = vote_app.db.engine.dialect.name
+    return {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'database': database,
+        'config': {key: config[key] for key in (
+            'GRID_QUERY_MODE', 'VOTE_WRITE_MODE', 'VOTE_STORAGE', 'RANKING_MODE', 'DB_POOL_PROFILE',
+        )},
+        'args': vars(args),
+    }
+
+
+def write_results(path, results):
+    text = json.dumps(results, indent=2, ensure_ascii=False)
+    if path:
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+def compare_with_baseline(results, baseline_path, threshold):
+    # *_ms の値がベースラインの threshold 倍を超えたものを遅くなったとして表示し、その件数を返す
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)
+
+    regressions = 0
+
+    def walk(current, previous, path):
+        nonlocal regressions
+        if isinstance(current, dict) and isinstance(previous, dict):
+            for key, value in current.items():
+                if key in previous:
+                    walk(value, previous[key], path + [key])
+        elif path and path[-1].endswith('_ms') and isinstance(current, (int, float)) \
+                and isinstance(previous, (int, float)) and previous > 0:
+            ratio = current / previous
+            flag = ''
+            if ratio > threshold:
+                flag = '  << slower'
+                regressions += 1
+            print(f"{'.'.join(path)}: {previous:.3f} -> {current:.3f} ms ({ratio:.2f}x){flag}", file=sys.stderr)
+
+    walk(results['results'], baseline.get('results', {}), [])
+    return regressions
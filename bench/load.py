@@ -0,0 +1,202 @@
+# 一覧・ランキング・投票を混ぜた負荷をかけ、スループットとレイテンシ、失われた票の数を計測する
+#   python -m bench.load --target client --duration 10 --threads 4 --output results.json
+#   python -m bench.load --target wsgi --database-url postgresql://localhost/splat_bench
+import argparse
+import itertools
+import json
+import random
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import Counter
+
+from bench.common import load_app, summarize, run_metadata, write_results, compare_with_baseline
+
+
+class ZipfPicker:
+    # 人気が一部のキットに偏った投票先を選ぶ (順位 r の重みは 1 / r^s)
+    def __init__(self, kit_ids, s, seed):
+        self.kit_ids = list(kit_ids)
+        random.Random(seed).shuffle(self.kit_ids)
+        self.cum_weights = list(itertools.accumulate(1 / (rank ** s) for rank in range(1, len(self.kit_ids) + 1)))
+
+    def pick(self, rnd):
+        return rnd.choices(self.kit_ids, cum_weights=self.cum_weights)[0]
+
+
+class TestClientTarget:
+    def __init__(self, vote_app):
+        self.vote_app = vote_app
+        self.local = threading.local()
+
+    def request(self, method, path, body=None):
+        if not hasattr(self.local, 'client'):
+            self.local.client = self.vote_app.app.test_client()
+        response = self.local.client.open(path, method=method, json=body)
+        return response.status_code, response.get_data()
+
+    def close(self):
+        pass
+
+
+class WSGIServerTarget:
+    # werkzeug のスレッド付きサーバーでアプリを起動し、HTTPでリクエストを送る
+    def __init__(self, vote_app):
+        from werkzeug.serving import make_server, WSGIRequestHandler
+
+        class QuietHandler(WSGIRequestHandler):
+            def log_request(self, *args, **kwargs):
+                pass
+
+        self.server = make_server('127.0.0.1', 0, vote_app.app, threaded=True, request_handler=QuietHandler)
+        self.base_url = f'http://127.0.0.1:{self.server.server_port}'
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def request(self, method, path, body=None):
+        data = json.dumps(body).encode() if body is not None else None
+        req = urllib.request.Request(self.base_url + path, data=data, method=method,
+                                     headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(req, timeout=30) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+    def close(self):
+        self.server.shutdown()
+
+
+def read_paths(vote_app):
+    types = ['all'] + list(dict.fromkeys(weapon['type'] for weapon in vote_app.main_weapons_list))
+    subs = ['all'] + [sub['name'] for sub in vote_app.sub_weapons_list]
+    return types, subs
+
+
+def worker(target, args, picker, types, subs, seed, deadline, latencies, acknowledged, errors, lock):
+    rnd = random.Random(seed)
+    local_latencies = {'grid': [], 'ranking': [], 'vote': []}
+    local_acknowledged = Counter()
+    local_errors = Counter()
+
+    while time.monotonic() < deadline:
+        roll = rnd.random()
+        if roll < args.write_ratio:
+            kind = 'vote'
+            kit_id = picker.pick(rnd)
+            method, path, body = 'POST', '/vote', {'weapon_id': kit_id}
+        elif roll < args.write_ratio + (1 - args.write_ratio) * args.ranking_ratio:
+            kind = 'ranking'
+            method, path, body = 'GET', f'/api/ranking_data?offset={rnd.randrange(0, 5) * 100}', None
+        else:
+            kind = 'grid'
+            query = {
+                'type': rnd.choice(types), 'sub': rnd.choice(subs),
+                'sort': rnd.choice(('default', 'votes_desc', 'votes_asc', 'trending')), 'page': rnd.randint(1, 3),
+            }
+            method, path, body = 'GET', '/?' + urllib.parse.urlencode(query), None
+
+        started = time.perf_counter()
+        try:
+            status, data = target.request(method, path, body)
+        except Exception as e:
+            local_errors[f'{kind}:{type(e).__name__}'] += 1
+            continue
+        local_latencies[kind].append(time.perf_counter() - started)
+
+        if status != 200:
+            local_errors[f'{kind}:{status}'] += 1
+        elif kind == 'vote':
+            if json.loads(data).get('success'):
+                local_acknowledged[kit_id] += 1
+            else:
+                local_errors['vote:failed'] += 1
+
+    with lock:
+        for kind, values in local_latencies.items():
+            latencies[kind].extend(values)
+        acknowledged.update(local_acknowledged)
+        errors.update(local_errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='投票アプリの負荷テスト')
+    parser.add_argument('--target', choices=('client', 'wsgi'), default='client',
+                        help='client: Flaskのテストクライアント / wsgi: werkzeugのサーバー経由のHTTP')
+    parser.add_argument('--database-url', help='既定は一時ディレクトリのSQLite (postgresql://... でローカルのPostgres)')
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE',
+                        help='アプリの設定 (例: VOTE_WRITE_MODE=buffered)')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--write-ratio', type=float, default=0.3, help='投票リクエストの割合')
+    parser.add_argument('--ranking-ratio', type=float, default=0.3, help='読み込みのうちランキングAPIの割合')
+    parser.add_argument('--zipf', type=float, default=1.2, help='投票先の偏り (Zipfの指数)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output')
+    parser.add_argument('--baseline')
+    parser.add_argument('--threshold', type=float, default=1.2)
+    args = parser.parse_args()
+
+    vote_app = load_app(args.database_url, dict(item.split('=', 1) for item in args.env))
+    with vote_app.app.app_context():
+        initial_counts = vote_app.fetch_vote_counts()
+
+    picker = ZipfPicker(vote_app.valid_kit_ids, args.zipf, args.seed)
+    types, subs = read_paths(vote_app)
+    target = TestClientTarget(vote_app) if args.target == 'client' else WSGIServerTarget(vote_app)
+
+    latencies = {'grid': [], 'ranking': [], 'vote': []}
+    acknowledged = Counter()
+    errors = Counter()
+    lock = threading.Lock()
+    deadline = time.monotonic() + args.duration
+    started = time.perf_counter()
+    workers = [
+        threading.Thread(target=worker, args=(target, args, picker, types, subs, args.seed + i, deadline,
+                                              latencies, acknowledged, errors, lock))
+        for i in range(args.threads)
+    ]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    target.close()
+
+    # 成功を返した票がすべてDBに残っているかを確認する
+    if vote_app.vote_buffer is not None:
+        vote_app.vote_buffer.flush()
+    with vote_app.app.app_context():
+        final_counts = vote_app.fetch_vote_counts(list(acknowledged)) if acknowledged else {}
+    lost = sum(
+        max(0, count - (final_counts.get(kit_id, 0) - initial_counts.get(kit_id, 0)))
+        for kit_id, count in acknowledged.items()
+    )
+
+    total_requests = sum(len(values) for values in latencies.values())
+    results = {
+        'throughput_rps': total_requests / elapsed,
+        'requests': total_requests,
+        'latency': {kind: summarize(values) for kind, values in latencies.items()},
+        'latency_all': summarize([value for values in latencies.values() for value in values]),
+        'votes_acknowledged': sum(acknowledged.values()),
+        'lost_updates': lost,
+        'hot_kits': [{'id': kit_id, 'votes': count} for kit_id, count in acknowledged.most_common(5)],
+        'errors': dict(errors),
+    }
+    output = {'benchmark': 'load', 'meta': run_metadata(vote_app, args), 'results': results}
+    print(f"{results['throughput_rps']:.1f} req/s, p99 {results['latency_all'].get('p99_ms', 0):.2f} ms, "
+          f"lost updates {lost}, errors {sum(errors.values())}", file=sys.stderr)
+    write_results(args.output, output)
+
+    if lost:
+        sys.exit(2)
+    if args.baseline and compare_with_baseline(output, args.baseline, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+# 一覧ページの絞り込み・並べ替え・ページ分けを、すべての絞り込みの組み合わせについて計測する
+#   python -m bench.micro --output results.json [--baseline baseline.json]
+import argparse
+import random
+import sys
+import time
+
+from bench.common import load_app, summarize, run_metadata, write_results, compare_with_baseline
+
+SORT_ORDERS = ('default', 'votes_desc', 'votes_asc', 'trending')
+PER_PAGE = 100
+
+
+def filter_combinations(vote_app):
+    types = ['all'] + list(dict.fromkeys(weapon['type'] for weapon in vote_app.main_weapons_list))
+    subs = ['all'] + [sub['name'] for sub in vote_app.sub_weapons_list]
+    specials = ['all'] + [special['name'] for special in vote_app.special_weapons_list]
+    return [(t, s, p) for t in types for s in subs for p in specials]
+
+
+def seed_random_votes(vote_app, seed):
+    # 並べ替えが意味を持つように投票数をばらつかせる
+    rnd = random.Random(seed)
+    counts = {kit_id: rnd.randint(0, 50) for kit_id in vote_app.valid_kit_ids}
+    table = vote_app.Votes.__table__
+    with vote_app.app.app_context():
+        vote_app.db.session.connection().execute(
+            table.update().where(table.c.weapon_id == vote_app.db.bindparam('kit_id'))
+            .values(vote_count=vote_app.db.bindparam('count')),
+            [{'kit_id': kit_id, 'count': count} for kit_id, count in counts.items()],
+        )
+        vote_app.db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='一覧ページの絞り込み・並べ替えのベンチマーク')
+    parser.add_argument('--database-url', help='既定は一時ディレクトリのSQLite')
+    parser.add_argument('--mode', choices=('memory', 'sql'), default='memory', help='GRID_QUERY_MODE')
+    parser.add_argument('--sorts', default=','.join(SORT_ORDERS))
+    parser.add_argument('--repeat', type=int, default=3, help='組み合わせごとのキャッシュ済みの計測回数')
+    parser.add_argument('--sample', type=int, default=0, help='組み合わせを無作為にこの数だけ選ぶ (0ならすべて)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output')
+    parser.add_argument('--baseline')
+    parser.add_argument('--threshold', type=float, default=1.2)
+    args = parser.parse_args()
+
+    vote_app = load_app(args.database_url, {'GRID_QUERY_MODE': args.mode})
+    seed_random_votes(vote_app, args.seed)
+
+    combinations = filter_combinations(vote_app)
+    if args.sample:
+        combinations = random.Random(args.seed).sample(combinations, min(args.sample, len(combinations)))
+    grid_page = vote_app.grid_page_from_sql if args.mode == 'sql' else vote_app.grid_page_from_index
+
+    results = {}
+    slowest = []
+    with vote_app.app.app_context():
+        for sort_order in args.sorts.split(','):
+            cold, warm = [], []
+            for type_filter, sub_filter, special_filter in combinations:
+                # 1回目は絞り込み結果のキャッシュを空にして計測し、以降はキャッシュ済みの状態で計測する
+                vote_app.filter_kit_ids.cache_clear()
+                started = time.perf_counter()
+                rows, total = grid_page(type_filter, sub_filter, special_filter, sort_order, 0, PER_PAGE)
+                elapsed = time.perf_counter() - started
+                cold.append(elapsed)
+                slowest.append((elapsed, sort_order, type_filter, sub_filter, special_filter, total))
+
+                last_page_start = max(0, (total - 1) // PER_PAGE * PER_PAGE)
+                for _ in range(args.repeat):
+                    started = time.perf_counter()
+                    grid_page(type_filter, sub_filter, special_filter, sort_order, last_page_start, last_page_start + PER_PAGE)
+                    warm.append(time.perf_counter() - started)
+            results[sort_order] = {'cold': summarize(cold), 'warm': summarize(warm)}
+            print(f"{sort_order}: cold p95 {results[sort_order]['cold']['p95_ms']:.3f} ms, "
+                  f"warm p95 {results[sort_order]['warm']['p95_ms']:.3f} ms", file=sys.stderr)
+
+    slowest.sort(reverse=True)
+    output = {
+        'benchmark': 'grid',
+        'meta': dict(run_metadata(vote_app, args), combinations=len(combinations)),
+        'results': results,
+        'slowest': [
+            {'ms': elapsed * 1000, 'sort': sort_order, 'type': t, 'sub': s, 'special': p, 'total': total}
+            for elapsed, sort_order, t, s, p, total in slowest[:10]
+        ],
+    }
+    write_results(args.output, output)
+
+    if args.baseline and compare_with_baseline(output, args.baseline, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
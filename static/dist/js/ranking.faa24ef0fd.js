@@ -0,0 +1,141 @@
+document.addEventListener('DOMContentLoaded', () => {
+    const rankingList = document.getElementById('ranking-list');
+    const loadMoreBtn = document.getElementById('load-more-btn');
+    const loader = document.getElementById('loader');
+    
+    let currentOffset = 0; // 現在読み込んでいる順位
+    let cursor = null; // 最後に読み込んだブキの "投票数:ID" (次のページの取得位置)
+    let isLoading = false;
+
+    // ランキングデータをサーバーから取得する関数
+    async function fetchRankingData() {
+        if (isLoading) return;
+        isLoading = true;
+        
+        loader.style.display = 'block';
+        loadMoreBtn.disabled = true;
+
+        try {
+            const url = cursor ? `/api/ranking_data?after=${cursor}` : '/api/ranking_data';
+            const response = await fetch(url);
+            const data = await response.json();
+
+            if (data.length > 0) {
+                appendRankingItems(data);
+                currentOffset += data.length;
+                const last = data[data.length - 1];
+                cursor = `${last.vote_count}:${last.id}`;
+            } else {
+                // これ以上データがない場合
+                loadMoreBtn.textContent = 'すべてのブキを読み込みました';
+                loadMoreBtn.disabled = true;
+            }
+        } catch (error) {
+            console.error('ランキングデータの取得に失敗しました:', error);
+            loadMoreBtn.textContent = 'エラーが発生しました';
+        } finally {
+            isLoading = false;
+            loader.style.display = 'none';
+            if (loadMoreBtn.textContent !== 'すべてのブキを読み込みました') {
+                loadMoreBtn.disabled = false;
+            }
+        }
+    }
+
+    // 取得したデータをHTMLに変換して追加する関数
+    function appendRankingItems(items) {
+        items.forEach((item, index) => {
+            const rank = currentOffset + index + 1;
+
+            const rankItem = document.createElement('div');
+            rankItem.className = 'ranking-item';
+
+            let rankText = rank;
+            let rankClass = '';
+
+            if (rank === 1) {
+                rankClass = 'rank-1st';
+                rankText = `${rank}<span class="rank-medal gold"></span>`;
+            } else if (rank === 2) {
+                rankClass = 'rank-2nd';
+                rankText = `${rank}<span class="rank-medal silver"></span>`;
+            } else if (rank === 3) {
+                rankClass = 'rank-3rd';
+                rankText = `${rank}<span class="rank-medal bronze"></span>`;
+            }
+
+            rankItem.innerHTML = `
+                <div class="rank-col ${rankClass}">
+                <span class="rank-number-with-medal">${rankText}</span>
+                </div>
+                <div class="weapon-col">
+                <img src="${item.main_image_url}" alt="${item.main.name}" class="main-icon">
+                <span class="weapon-name">${item.main.name}</span>
+                <div class="weapon-details">
+                <img src="${item.sub_image_url}" alt="${item.sub.name}" class="sub-icon">
+                <img src="${item.special_image_url}" alt="${item.special.name}" class="special-icon">
+                </div>
+                </div>
+                <div class="votes-col" id="ranking-votes-${item.id}">${item.vote_count} 票</div>
+            `;
+            rankingList.appendChild(rankItem);
+        });
+    }
+
+    function updateVoteCounts(counts) {
+        Object.entries(counts).forEach(([weaponId, voteCount]) => {
+            const votesCol = document.getElementById(`ranking-votes-${weaponId}`);
+            if (votesCol) {
+                votesCol.textContent = `${voteCount} 票`;
+            }
+        });
+    }
+
+    // 投票数の変更を Server-Sent Events で受け取り、表示中のブキの得票数を更新する (サーバー側で有効な場合のみ)
+    function subscribeVoteUpdates() {
+        const stream = new EventSource('/api/ranking_stream');
+        stream.addEventListener('votes', event => {
+            updateVoteCounts(JSON.parse(event.data).counts);
+        });
+    }
+
+    // SSEを使わない場合は、上位のブキの得票数の変化を定期的に取得する
+    const POLL_INTERVAL = 10000;
+    const MAX_POLL_IDS = 200; // サーバー側の VOTE_DELTA_MAX_IDS と合わせる
+    let deltaVersion = null;
+
+    function pollVoteDeltas() {
+        const ids = Array.from(rankingList.querySelectorAll('[id^="ranking-votes-"]'))
+            .slice(0, MAX_POLL_IDS)
+            .map(element => element.id.replace('ranking-votes-', ''));
+        if (document.hidden || ids.length === 0) return;
+
+        const params = new URLSearchParams({ ids: ids.join(',') });
+        if (deltaVersion) {
+            params.append('since', deltaVersion);
+        }
+        fetch(`/api/vote_deltas?${params.toString()}`)
+        .then(response => {
+            if (!response.ok) {
+                throw new Error(`Failed to fetch vote deltas: ${response.status}`);
+            }
+            return response.json();
+        })
+        .then(data => {
+            deltaVersion = data.version;
+            updateVoteCounts(data.counts);
+        })
+        .catch(error => console.error('Error:', error));
+    }
+
+    // --- イベントリスナー ---
+    loadMoreBtn.addEventListener('click', fetchRankingData);
+
+    // --- 初期読み込み ---
+    fetchRankingData();
+    if (rankingList.dataset.stream === 'on' && window.EventSource) {
+        subscribeVoteUpdates();
+    } else {
+        setInterval(pollVoteDeltas, POLL_INTERVAL);
+    }
+});
\ No newline at end of file
@@ -0,0 +1,246 @@
+document.addEventListener('DOMContentLoaded', () => {
+    // --- 定数とDOM要素の取得 ---
+    const MAX_VOTES_PER_DAY = 10;
+    const voteButtons = document.querySelectorAll('.vote-button');
+    const votesRemainingElement = document.getElementById('votes-remaining');
+
+    // --- ローカルストレージから投票データを読み込む ---
+    let dailyVotes = { count: 0, date: new Date().toLocaleDateString() };
+    const savedVotes = localStorage.getItem('dailyVoteData');
+    if (savedVotes) {
+        const parsedData = JSON.parse(savedVotes);
+        if (parsedData.date === dailyVotes.date) {
+            dailyVotes = parsedData;
+        } else {
+            localStorage.setItem('dailyVoteData', JSON.stringify(dailyVotes));
+        }
+    }
+
+    // --- 送信待ちの票 (クリックをまとめて /vote/batch で送る) ---
+    const BATCH_DELAY = 800;
+    let pendingVotes = {}; // weaponId -> 票数
+    let pendingTotal = 0;
+    let batchTimer = null;
+
+    // --- UIを更新する関数 ---
+    function updateUI() {
+        const votesLeft = MAX_VOTES_PER_DAY - dailyVotes.count - pendingTotal;
+        votesRemainingElement.textContent = votesLeft;
+
+        if (votesLeft <= 0) {
+            voteButtons.forEach(button => {
+                button.disabled = true;
+                button.textContent = '本日の上限です';
+            });
+        }
+    }
+
+    const voteLimiter = document.getElementById('vote-limiter');
+
+// 画面幅をチェックするメディアクエリ
+const mediaQuery = window.matchMedia('(max-width: 768px)');
+
+function handleScroll() {
+    // ページ全体の高さ (より正確な方法に変更)
+    const scrollHeight = document.documentElement.scrollHeight;
+    // 表示領域の高さ
+    const clientHeight = document.documentElement.clientHeight;
+    // 現在のスクロール位置
+    const scrollY = window.scrollY;
+
+    // 一番下までスクロールしたかをチェック (20pxの遊びを持たせる)
+    const isAtBottom = scrollY + clientHeight >= scrollHeight - 100;
+
+    if (isAtBottom) {
+        voteLimiter.classList.add('is-hidden');
+        console.log("hidden")
+    } else {
+        voteLimiter.classList.remove('is-hidden');
+    }
+}
+
+// 画面幅に応じてイベントリスナーを追加/削除する関数
+function setupScrollListener(event) {
+    if (event.matches) {
+        // 画面が狭い場合 (スマホ) はスクロール監視を開始
+        window.addEventListener('scroll', handleScroll);
+    } else {
+        // 画面が広い場合 (PC) はスクロール監視を解除し、常に表示
+        window.removeEventListener('scroll', handleScroll);
+        voteLimiter.classList.remove('is-hidden');
+    }
+}
+
+// 初回読み込み時にチェック
+setupScrollListener(mediaQuery);
+
+// 画面幅が変わったときにもチェック
+mediaQuery.addEventListener('change', setupScrollListener);
+
+    // --- CSRFトークンの取得 ---
+    // ページはキャッシュして共有されるため、トークンは最初の投票時に個別に取得する
+    let csrfTokenPromise = null;
+    let csrfToken = null; // ページを離れるときの送信用に取得済みのトークンを保持
+    function getCsrfToken() {
+        if (!csrfTokenPromise) {
+            csrfTokenPromise = fetch('/api/csrf_token', { credentials: 'same-origin' })
+                .then(response => response.json())
+                .then(data => {
+                    csrfToken = data.csrf_token;
+                    return csrfToken;
+                })
+                .catch(error => {
+                    csrfTokenPromise = null; // 次の投票で取り直す
+                    throw error;
+                });
+        }
+        return csrfTokenPromise;
+    }
+
+    // --- 投票処理の関数 ---
+    function addToVoteCount(weaponId, delta) {
+        const voteCountElement = document.getElementById(`vote-count-${weaponId}`);
+        if (voteCountElement) {
+            voteCountElement.textContent = `${parseInt(voteCountElement.textContent, 10) + delta} 票`;
+        }
+    }
+
+    function handleVote(button, weaponId) {
+        if (dailyVotes.count + pendingTotal >= MAX_VOTES_PER_DAY) {
+            alert('本日の投票回数の上限に達しました。');
+            return;
+        }
+
+        // クリックはすぐに画面へ反映し、送信は少し待ってまとめて行う
+        pendingVotes[weaponId] = (pendingVotes[weaponId] || 0) + 1;
+        pendingTotal++;
+        addToVoteCount(weaponId, 1);
+        updateUI();
+        getCsrfToken().catch(error => console.error('Error:', error)); // 送信前にトークンを取得しておく
+
+        clearTimeout(batchTimer);
+        batchTimer = setTimeout(flushVotes, BATCH_DELAY);
+    }
+
+    function takePendingVotes() {
+        const votes = Object.entries(pendingVotes).map(([weaponId, n]) => ({ weapon_id: parseInt(weaponId, 10), n }));
+        const total = pendingTotal;
+        pendingVotes = {};
+        pendingTotal = 0;
+        clearTimeout(batchTimer);
+        return { votes, total };
+    }
+
+    function flushVotes() {
+        const { votes, total } = takePendingVotes();
+        if (votes.length === 0) return;
+
+        getCsrfToken()
+        .then(token => fetch('/vote/batch', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'X-CSRFToken': token // ここでトークンをヘッダーに含める
+            },
+            body: JSON.stringify({ votes }),
+        }))
+        .then(response => {
+            if (!response.ok) {
+                // レートリミット超過(429)などのエラーをここで捕捉
+                return response.json().catch(() => ({})).then(data => {
+                    if (data.remaining_votes !== null && data.remaining_votes !== undefined) {
+                        // 本日の上限に達していたらサーバー側の残り票数に合わせる
+                        dailyVotes.count = MAX_VOTES_PER_DAY - data.remaining_votes;
+                        localStorage.setItem('dailyVoteData', JSON.stringify(dailyVotes));
+                    } else {
+                        alert('リクエストが多すぎます。少し時間を置いてから再試行してください。');
+                    }
+                    throw new Error(data.error || 'Too Many Requests');
+                });
+            }
+            return response.json();
+        })
+        .then(data => {
+            if (!data.success) {
+                throw new Error(data.error);
+            }
+            Object.entries(data.new_vote_counts).forEach(([weaponId, voteCount]) => {
+                const voteCountElement = document.getElementById(`vote-count-${weaponId}`);
+                if (voteCountElement) {
+                    voteCountElement.textContent = `${voteCount + (pendingVotes[weaponId] || 0)} 票`;
+                }
+            });
+            dailyVotes.count += total;
+            if (data.remaining_votes !== null && data.remaining_votes !== undefined) {
+                // サーバー側で数えた残り票数に合わせる
+                dailyVotes.count = MAX_VOTES_PER_DAY - data.remaining_votes;
+            }
+            localStorage.setItem('dailyVoteData', JSON.stringify(dailyVotes));
+            updateUI();
+        })
+        .catch(error => {
+            console.error('Error:', error);
+            alert('投票に失敗しました。');
+            // 先に反映していた票を元に戻す
+            votes.forEach(vote => addToVoteCount(vote.weapon_id, -vote.n));
+            updateUI();
+        });
+    }
+
+    // ページを離れるときは待たずに送る (keepalive でページを閉じても送信を続ける)
+    window.addEventListener('pagehide', () => {
+        if (pendingTotal === 0 || !csrfToken) return;
+
+        const { votes, total } = takePendingVotes();
+        fetch('/vote/batch', {
+            method: 'POST',
+            keepalive: true,
+            headers: { 'Content-Type': 'application/json', 'X-CSRFToken': csrfToken },
+            body: JSON.stringify({ votes }),
+        });
+        dailyVotes.count += total;
+        localStorage.setItem('dailyVoteData', JSON.stringify(dailyVotes));
+    });
+
+    // --- 表示中のブキの投票数を定期的に更新 ---
+    // ページ全体を読み直さず、前回からの差分だけを取得する
+    const POLL_INTERVAL = 10000;
+    const visibleIds = Array.from(voteButtons).map(button => button.dataset.id);
+    let deltaVersion = null;
+
+    function pollVoteDeltas() {
+        if (document.hidden || visibleIds.length === 0) return;
+
+        const params = new URLSearchParams({ ids: visibleIds.join(',') });
+        if (deltaVersion) {
+            params.append('since', deltaVersion);
+        }
+        fetch(`/api/vote_deltas?${params.toString()}`)
+        .then(response => {
+            if (!response.ok) {
+                throw new Error(`Failed to fetch vote deltas: ${response.status}`);
+            }
+            return response.json();
+        })
+        .then(data => {
+            deltaVersion = data.version;
+            Object.entries(data.counts).forEach(([weaponId, voteCount]) => {
+                const voteCountElement = document.getElementById(`vote-count-${weaponId}`);
+                if (voteCountElement) {
+                    voteCountElement.textContent = `${voteCount + (pendingVotes[weaponId] || 0)} 票`;
+                }
+            });
+        })
+        .catch(error => console.error('Error:', error));
+    }
+
+    // --- 初期化処理 ---
+    voteButtons.forEach(button => {
+        button.addEventListener('click', () => {
+            const weaponId = button.dataset.id;
+            handleVote(button, weaponId);
+        });
+    });
+    updateUI();
+    setInterval(pollVoteDeltas, POLL_INTERVAL);
+});
\ No newline at end of file
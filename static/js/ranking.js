@@ -4,6 +4,7 @@ document.addEventListener('DOMContentLoaded', () => {
     const loader = document.getElementById('loader');
     
     let currentOffset = 0; // 現在読み込んでいる順位
+    let cursor = null; // 最後に読み込んだブキの "投票数:ID" (次のページの取得位置)
     let isLoading = false;
 
     // ランキングデータをサーバーから取得する関数
@@ -15,12 +16,15 @@ document.addEventListener('DOMContentLoaded', () => {
         loadMoreBtn.disabled = true;
 
         try {
-            const response = await fetch(`/api/ranking_data?offset=${currentOffset}`);
+            const url = cursor ? `/api/ranking_data?after=${cursor}` : '/api/ranking_data';
+            const response = await fetch(url);
             const data = await response.json();
 
             if (data.length > 0) {
                 appendRankingItems(data);
                 currentOffset += data.length;
+                const last = data[data.length - 1];
+                cursor = `${last.vote_count}:${last.id}`;
             } else {
                 // これ以上データがない場合
                 loadMoreBtn.textContent = 'すべてのブキを読み込みました';
@@ -65,22 +69,73 @@ document.addEventListener('DOMContentLoaded', () => {
                 <span class="rank-number-with-medal">${rankText}</span>
                 </div>
                 <div class="weapon-col">
-                <img src="/static/images/main/${item.main.image}" alt="${item.main.name}" class="main-icon">
+                <img src="${item.main_image_url}" alt="${item.main.name}" class="main-icon">
                 <span class="weapon-name">${item.main.name}</span>
                 <div class="weapon-details">
-                <img src="/static/images/sub/${item.sub.image}" alt="${item.sub.name}" class="sub-icon">
-                <img src="/static/images/special/${item.special.image}" alt="${item.special.name}" class="special-icon">
+                <img src="${item.sub_image_url}" alt="${item.sub.name}" class="sub-icon">
+                <img src="${item.special_image_url}" alt="${item.special.name}" class="special-icon">
                 </div>
                 </div>
-                <div class="votes-col">${item.vote_count} 票</div>
+                <div class="votes-col" id="ranking-votes-${item.id}">${item.vote_count} 票</div>
             `;
             rankingList.appendChild(rankItem);
         });
     }
 
+    function updateVoteCounts(counts) {
+        Object.entries(counts).forEach(([weaponId, voteCount]) => {
+            const votesCol = document.getElementById(`ranking-votes-${weaponId}`);
+            if (votesCol) {
+                votesCol.textContent = `${voteCount} 票`;
+            }
+        });
+    }
+
+    // 投票数の変更を Server-Sent Events で受け取り、表示中のブキの得票数を更新する (サーバー側で有効な場合のみ)
+    function subscribeVoteUpdates() {
+        const stream = new EventSource('/api/ranking_stream');
+        stream.addEventListener('votes', event => {
+            updateVoteCounts(JSON.parse(event.data).counts);
+        });
+    }
+
+    // SSEを使わない場合は、上位のブキの得票数の変化を定期的に取得する
+    const POLL_INTERVAL = 10000;
+    const MAX_POLL_IDS = 200; // サーバー側の VOTE_DELTA_MAX_IDS と合わせる
+    let deltaVersion = null;
+
+    function pollVoteDeltas() {
+        const ids = Array.from(rankingList.querySelectorAll('[id^="ranking-votes-"]'))
+            .slice(0, MAX_POLL_IDS)
+            .map(element => element.id.replace('ranking-votes-', ''));
+        if (document.hidden || ids.length === 0) return;
+
+        const params = new URLSearchParams({ ids: ids.join(',') });
+        if (deltaVersion) {
+            params.append('since', deltaVersion);
+        }
+        fetch(`/api/vote_deltas?${params.toString()}`)
+        .then(response => {
+            if (!response.ok) {
+                throw new Error(`Failed to fetch vote deltas: ${response.status}`);
+            }
+            return response.json();
+        })
+        .then(data => {
+            deltaVersion = data.version;
+            updateVoteCounts(data.counts);
+        })
+        .catch(error => console.error('Error:', error));
+    }
+
     // --- イベントリスナー ---
     loadMoreBtn.addEventListener('click', fetchRankingData);
 
     // --- 初期読み込み ---
     fetchRankingData();
+    if (rankingList.dataset.stream === 'on' && window.EventSource) {
+        subscribeVoteUpdates();
+    } else {
+        setInterval(pollVoteDeltas, POLL_INTERVAL);
+    }
 });
\ No newline at end of file
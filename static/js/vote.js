@@ -16,9 +16,15 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
+    // --- 送信待ちの票 (クリックをまとめて /vote/batch で送る) ---
+    const BATCH_DELAY = 800;
+    let pendingVotes = {}; // weaponId -> 票数
+    let pendingTotal = 0;
+    let batchTimer = null;
+
     // --- UIを更新する関数 ---
     function updateUI() {
-        const votesLeft = MAX_VOTES_PER_DAY - dailyVotes.count;
+        const votesLeft = MAX_VOTES_PER_DAY - dailyVotes.count - pendingTotal;
         votesRemainingElement.textContent = votesLeft;
 
         if (votesLeft <= 0) {
@@ -71,64 +77,163 @@ setupScrollListener(mediaQuery);
 // 画面幅が変わったときにもチェック
 mediaQuery.addEventListener('change', setupScrollListener);
 
-    const csrfToken = document.querySelector('meta[name="csrf-token"]').getAttribute('content');
+    // --- CSRFトークンの取得 ---
+    // ページはキャッシュして共有されるため、トークンは最初の投票時に個別に取得する
+    let csrfTokenPromise = null;
+    let csrfToken = null; // ページを離れるときの送信用に取得済みのトークンを保持
+    function getCsrfToken() {
+        if (!csrfTokenPromise) {
+            csrfTokenPromise = fetch('/api/csrf_token', { credentials: 'same-origin' })
+                .then(response => response.json())
+                .then(data => {
+                    csrfToken = data.csrf_token;
+                    return csrfToken;
+                })
+                .catch(error => {
+                    csrfTokenPromise = null; // 次の投票で取り直す
+                    throw error;
+                });
+        }
+        return csrfTokenPromise;
+    }
 
     // --- 投票処理の関数 ---
+    function addToVoteCount(weaponId, delta) {
+        const voteCountElement = document.getElementById(`vote-count-${weaponId}`);
+        if (voteCountElement) {
+            voteCountElement.textContent = `${parseInt(voteCountElement.textContent, 10) + delta} 票`;
+        }
+    }
+
     function handleVote(button, weaponId) {
-        if (dailyVotes.count >= MAX_VOTES_PER_DAY) {
+        if (dailyVotes.count + pendingTotal >= MAX_VOTES_PER_DAY) {
             alert('本日の投票回数の上限に達しました。');
             return;
         }
 
-        const originalText = '投票する'; // 元のテキストを定義
-        button.disabled = true;
-        // button.textContent = '投票中...'; // 瞬時に処理が終わるため不要に
+        // クリックはすぐに画面へ反映し、送信は少し待ってまとめて行う
+        pendingVotes[weaponId] = (pendingVotes[weaponId] || 0) + 1;
+        pendingTotal++;
+        addToVoteCount(weaponId, 1);
+        updateUI();
+        getCsrfToken().catch(error => console.error('Error:', error)); // 送信前にトークンを取得しておく
+
+        clearTimeout(batchTimer);
+        batchTimer = setTimeout(flushVotes, BATCH_DELAY);
+    }
+
+    function takePendingVotes() {
+        const votes = Object.entries(pendingVotes).map(([weaponId, n]) => ({ weapon_id: parseInt(weaponId, 10), n }));
+        const total = pendingTotal;
+        pendingVotes = {};
+        pendingTotal = 0;
+        clearTimeout(batchTimer);
+        return { votes, total };
+    }
 
-        fetch('/vote', {
+    function flushVotes() {
+        const { votes, total } = takePendingVotes();
+        if (votes.length === 0) return;
+
+        getCsrfToken()
+        .then(token => fetch('/vote/batch', {
             method: 'POST',
-            headers: { 
+            headers: {
                 'Content-Type': 'application/json',
-                'X-CSRFToken': csrfToken // ここでトークンをヘッダーに含める
+                'X-CSRFToken': token // ここでトークンをヘッダーに含める
             },
-            body: JSON.stringify({ weapon_id: parseInt(weaponId, 10) }),
-        })
-        .then(response => { // thenの中身を少し修正
+            body: JSON.stringify({ votes }),
+        }))
+        .then(response => {
             if (!response.ok) {
                 // レートリミット超過(429)などのエラーをここで捕捉
-                alert('リクエストが多すぎます。少し時間を置いてから再試行してください。');
-                throw new Error('Too Many Requests');
+                return response.json().catch(() => ({})).then(data => {
+                    if (data.remaining_votes !== null && data.remaining_votes !== undefined) {
+                        // 本日の上限に達していたらサーバー側の残り票数に合わせる
+                        dailyVotes.count = MAX_VOTES_PER_DAY - data.remaining_votes;
+                        localStorage.setItem('dailyVoteData', JSON.stringify(dailyVotes));
+                    } else {
+                        alert('リクエストが多すぎます。少し時間を置いてから再試行してください。');
+                    }
+                    throw new Error(data.error || 'Too Many Requests');
+                });
             }
             return response.json();
         })
         .then(data => {
-            if (data.success) {
+            if (!data.success) {
+                throw new Error(data.error);
+            }
+            Object.entries(data.new_vote_counts).forEach(([weaponId, voteCount]) => {
                 const voteCountElement = document.getElementById(`vote-count-${weaponId}`);
                 if (voteCountElement) {
-                    voteCountElement.textContent = `${data.new_vote_count} 票`;
+                    voteCountElement.textContent = `${voteCount + (pendingVotes[weaponId] || 0)} 票`;
                 }
-                dailyVotes.count++;
-                localStorage.setItem('dailyVoteData', JSON.stringify(dailyVotes));
-                updateUI();
-
-                // ▼▼▼ 変更点 ▼▼▼
-                // 投票完了後、すぐにボタンを再度有効化する
-                if (dailyVotes.count < MAX_VOTES_PER_DAY) {
-                    button.disabled = false;
-                }
-                // ▲▲▲ 変更点 ▲▲▲
-
-            } else {
-                alert('投票に失敗しました。');
-                button.disabled = false;
+            });
+            dailyVotes.count += total;
+            if (data.remaining_votes !== null && data.remaining_votes !== undefined) {
+                // サーバー側で数えた残り票数に合わせる
+                dailyVotes.count = MAX_VOTES_PER_DAY - data.remaining_votes;
             }
+            localStorage.setItem('dailyVoteData', JSON.stringify(dailyVotes));
+            updateUI();
         })
         .catch(error => {
             console.error('Error:', error);
-            alert('エラーが発生しました。');
-            button.disabled = false;
+            alert('投票に失敗しました。');
+            // 先に反映していた票を元に戻す
+            votes.forEach(vote => addToVoteCount(vote.weapon_id, -vote.n));
+            updateUI();
         });
     }
 
+    // ページを離れるときは待たずに送る (keepalive でページを閉じても送信を続ける)
+    window.addEventListener('pagehide', () => {
+        if (pendingTotal === 0 || !csrfToken) return;
+
+        const { votes, total } = takePendingVotes();
+        fetch('/vote/batch', {
+            method: 'POST',
+            keepalive: true,
+            headers: { 'Content-Type': 'application/json', 'X-CSRFToken': csrfToken },
+            body: JSON.stringify({ votes }),
+        });
+        dailyVotes.count += total;
+        localStorage.setItem('dailyVoteData', JSON.stringify(dailyVotes));
+    });
+
+    // --- 表示中のブキの投票数を定期的に更新 ---
+    // ページ全体を読み直さず、前回からの差分だけを取得する
+    const POLL_INTERVAL = 10000;
+    const visibleIds = Array.from(voteButtons).map(button => button.dataset.id);
+    let deltaVersion = null;
+
+    function pollVoteDeltas() {
+        if (document.hidden || visibleIds.length === 0) return;
+
+        const params = new URLSearchParams({ ids: visibleIds.join(',') });
+        if (deltaVersion) {
+            params.append('since', deltaVersion);
+        }
+        fetch(`/api/vote_deltas?${params.toString()}`)
+        .then(response => {
+            if (!response.ok) {
+                throw new Error(`Failed to fetch vote deltas: ${response.status}`);
+            }
+            return response.json();
+        })
+        .then(data => {
+            deltaVersion = data.version;
+            Object.entries(data.counts).forEach(([weaponId, voteCount]) => {
+                const voteCountElement = document.getElementById(`vote-count-${weaponId}`);
+                if (voteCountElement) {
+                    voteCountElement.textContent = `${voteCount + (pendingVotes[weaponId] || 0)} 票`;
+                }
+            });
+        })
+        .catch(error => console.error('Error:', error));
+    }
+
     // --- 初期化処理 ---
     voteButtons.forEach(button => {
         button.addEventListener('click', () => {
@@ -137,4 +242,5 @@ mediaQuery.addEventListener('change', setupScrollListener);
         });
     });
     updateUI();
+    setInterval(pollVoteDeltas, POLL_INTERVAL);
 });
\ No newline at end of file
@@ -0,0 +1,9 @@
+import pytest
+
+from bench.common import load_app
+
+
+@pytest.fixture(scope='session')
+def vote_app():
+    # 一時ディレクトリのSQLiteで app を読み込む (設定は読み込み時に決まるので1回だけ)
+    return load_app()
@@ -0,0 +1,24 @@
+# ビルド済みの静的ファイル (static/dist) のテスト
+import os
+import shutil
+
+import pytest
+
+
+def test_committed_assets_match_sources(vote_app, tmp_path, monkeypatch):
+    # static/dist はコミットして配信するので、元のファイルを変えたらビルドし直しているかを確かめる
+    static_folder = vote_app.app.static_folder
+    committed = vote_app.load_asset_manifest()
+    if not committed['assets']:
+        pytest.skip('static/dist is not built')
+    for path in list(committed['assets'].values()) + list(committed['webp'].values()):
+        assert os.path.exists(os.path.join(static_folder, path)), path
+
+    shutil.copytree(static_folder, tmp_path / 'static', ignore=shutil.ignore_patterns(vote_app.app.config['ASSET_DIST_DIR']))
+    monkeypatch.setattr(vote_app.app, 'static_folder', str(tmp_path / 'static'))
+    built, webp_enabled = vote_app.build_static_assets()
+
+    assert built['assets'] == committed['assets'], 'Run flask build-assets and commit static/dist'
+    # WebP の中身は Pillow のバージョンで変わるので、どの画像に作るかだけを比べる
+    if webp_enabled:
+        assert set(built['webp']) == set(committed['webp'])
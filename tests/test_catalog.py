@@ -0,0 +1,22 @@
+# カタログ (kits テーブル) の初期化のテスト
+
+
+def test_reseed_updates_changed_kit_rows(vote_app):
+    kits = vote_app.Kits
+    valid_id = vote_app.valid_kit_ids[0]
+    excluded_id = vote_app.excluded_kit_ids[0]
+    # 以前のカタログで除外されていた (またはされていなかった) キットの行を作る
+    with vote_app.app.app_context():
+        vote_app.db.session.query(kits).filter(kits.kit_id == valid_id).update({'excluded': True})
+        vote_app.db.session.query(kits).filter(kits.kit_id == excluded_id).update({'excluded': False, 'sub_id': 0})
+        vote_app.db.session.commit()
+
+    vote_app.init_db_postgres(force=True)
+
+    with vote_app.app.app_context():
+        assert vote_app.db.session.get(kits, valid_id).excluded is False
+        assert vote_app.db.session.get(kits, excluded_id).excluded is True
+        assert vote_app.db.session.get(kits, excluded_id).sub_id == vote_app.kit_attributes(excluded_id)[1]
+        rows, total = vote_app.grid_page_from_sql('all', 'all', 'all', 'default', 0, 5)
+        assert [kit_id for kit_id, _ in rows] == list(vote_app.valid_kit_ids[:5])
+        assert total == len(vote_app.valid_kit_ids)
@@ -0,0 +1,40 @@
+# リクエストごとの計測 (Server-Timing / /metrics) のテスト
+import time
+
+from flask import g
+
+
+def test_queries_of_flush_in_request_are_counted(vote_app):
+    weapon_id = vote_app.valid_kit_ids[0]
+    history = vote_app.VoteHistory(3600, 48 * 3600, 30 * 86400)
+    with vote_app.app.test_request_context('/vote', method='POST'):
+        vote_app.start_request_timer()
+        history.add({weapon_id: 1}, time.time())
+        history.flush()
+        # バケットへの加算とコミットがこのリクエストのクエリとして数えられる
+        assert g.db_queries >= 1
+        assert g.timings.get('db', 0) > 0
+
+
+def test_server_timing_counts_vote_queries(vote_app):
+    client = vote_app.app.test_client()
+    enabled = vote_app.app.config['SERVER_TIMING_ENABLED']
+    vote_app.app.config['SERVER_TIMING_ENABLED'] = True
+    try:
+        response = client.post('/vote', json={'weapon_id': vote_app.valid_kit_ids[1]})
+    finally:
+        vote_app.app.config['SERVER_TIMING_ENABLED'] = enabled
+    assert response.status_code == 200
+    assert 'db;dur=' in response.headers['Server-Timing']
+
+
+def test_pool_timing_survives_dispose(vote_app):
+    with vote_app.app.app_context():
+        vote_app.db.engine.dispose()
+        before = dict(vote_app.db_pool_stats)
+        vote_app.db.session.execute(vote_app.db.text('SELECT 1'))
+        vote_app.db.session.rollback()
+        # 作り直されたプールでも接続の確立と取得を数える
+        assert isinstance(vote_app.db.engine.pool, vote_app.TimedPool)
+    assert vote_app.db_pool_stats['connects'] == before['connects'] + 1
+    assert vote_app.db_pool_stats['checkouts'] == before['checkouts'] + 1
@@ -0,0 +1,90 @@
+# 1日の投票数の上限 (DailyVoteQuota の条件付きupsertと払い戻し) のテスト
+import itertools
+
+import pytest
+
+client_numbers = itertools.count()
+
+
+@pytest.fixture
+def client():
+    # テストごとに別のクライアントとして数える
+    return f'192.0.2.{next(client_numbers)}'
+
+
+@pytest.fixture
+def app_context(vote_app):
+    with vote_app.app.app_context():
+        yield
+        vote_app.db.session.rollback()
+
+
+def make_quota(vote_app, daily_limit=5, burst=100, defer_commit=False):
+    return vote_app.DailyVoteQuota(daily_limit, burst, 0, 9, defer_commit=defer_commit)
+
+
+def used_votes(vote_app, quota, client):
+    vote_app.db.session.rollback()
+    return vote_app.db.session.query(vote_app.VoteQuota.vote_count) \
+        .filter_by(client_key=quota.client_key(client), day=quota.today()).scalar()
+
+
+def test_consume_stops_at_daily_limit(vote_app, app_context, client):
+    quota = make_quota(vote_app)
+    assert quota.consume(client, 3) == ('ok', 2)
+    # 上限を超える分は加算せず、現在の残りを返す
+    assert quota.consume(client, 3) == ('exceeded', 2)
+    assert used_votes(vote_app, quota, client) == 3
+    assert quota.consume(client, 2) == ('ok', 0)
+    assert used_votes(vote_app, quota, client) == 5
+
+
+def test_other_process_sees_the_shared_count(vote_app, app_context, client):
+    quota = make_quota(vote_app)
+    assert quota.consume(client, 5) == ('ok', 0)
+    # 使い切ったキャッシュを持たない別のプロセスでも、共有ストアの条件付き加算で拒否される
+    other = make_quota(vote_app)
+    assert other.consume(client, 1) == ('exceeded', 0)
+    assert used_votes(vote_app, quota, client) == 5
+
+
+def test_exhausted_client_is_rejected_without_the_store(vote_app, app_context, client, monkeypatch):
+    quota = make_quota(vote_app)
+    assert quota.consume(client, 5) == ('ok', 0)
+
+    def fail(*args, **kwargs):
+        raise AssertionError('The store was queried')
+
+    monkeypatch.setattr(vote_app.db.session, 'execute', fail)
+    assert quota.consume(client, 1) == ('exceeded', 0)
+
+
+def test_burst_and_oversized_requests_are_rejected(vote_app, app_context, client):
+    quota = make_quota(vote_app, burst=2)
+    assert quota.consume(client, 1)[0] == 'ok'
+    assert quota.consume(client, 1)[0] == 'ok'
+    assert quota.consume(client, 1) == ('rate_limited', None)
+    assert make_quota(vote_app).consume(client, 6) == ('exceeded', None)
+    assert used_votes(vote_app, quota, client) == 2
+
+
+def test_refund_gives_votes_back(vote_app, app_context, client):
+    quota = make_quota(vote_app)
+    assert quota.consume(client, 5) == ('ok', 0)
+    quota.refund(client, 2)
+    assert used_votes(vote_app, quota, client) == 3
+    # 使い切ったというキャッシュも消えている
+    assert quota.consume(client, 2) == ('ok', 0)
+
+
+def test_deferred_consume_rolls_back_with_the_vote(vote_app, app_context, client):
+    quota = make_quota(vote_app, defer_commit=True)
+    assert quota.consume(client, 5) == ('ok', 0)
+    # 票の書き込みに失敗してロールバックすると、同じトランザクションの加算も消える
+    vote_app.db.session.rollback()
+    assert used_votes(vote_app, quota, client) is None
+    quota.refund(client, 5, rolled_back=True)
+    assert used_votes(vote_app, quota, client) is None
+    assert quota.consume(client, 1) == ('ok', 4)
+    vote_app.db.session.commit()
+    assert used_votes(vote_app, quota, client) == 1
@@ -0,0 +1,179 @@
+# ランキング (SortedKeyList とキーセットページネーション) のテスト
+#   python -m pytest tests
+import random
+import threading
+
+import pytest
+
+from bench.micro import seed_random_votes
+
+
+def make_keys(rnd, n):
+    # 同数が多くなるように投票数の幅を狭くした (-投票数, weapon_id) のキー
+    return [(-rnd.randint(0, 20), weapon_id) for weapon_id in rnd.sample(range(20000), n)]
+
+
+@pytest.fixture(scope='module', autouse=True)
+def random_votes(vote_app):
+    seed_random_votes(vote_app, 1)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_sorted_key_list_matches_sorted(vote_app, seed):
+    rnd = random.Random(seed)
+    # load を小さくして、サブリストの分割と削除で空になる場合も通るようにする
+    sorted_key_list = type('SmallSortedKeyList', (vote_app.SortedKeyList,), {'load': 4})(make_keys(rnd, 50))
+    expected = sorted(sorted_key_list.slice(0, len(sorted_key_list)))
+
+    for _ in range(2000):
+        if expected and rnd.random() < 0.45:
+            key = rnd.choice(expected)
+            sorted_key_list.remove(key)
+            expected.remove(key)
+        else:
+            key = (-rnd.randint(0, 20), rnd.randrange(20000))
+            if key in expected:
+                continue
+            sorted_key_list.add(key)
+            expected.append(key)
+            expected.sort()
+
+        assert len(sorted_key_list) == len(expected)
+        start = rnd.randint(0, len(expected))
+        stop = rnd.randint(start, len(expected) + 5)
+        assert sorted_key_list.slice(start, stop) == expected[start:stop]
+        probe = (-rnd.randint(-1, 21), rnd.randrange(-1, 20001))
+        assert sorted_key_list.index(probe) == sum(1 for key in expected if key < probe)
+        limit = rnd.randint(1, 30)
+        assert sorted_key_list.after(probe, limit) == [key for key in expected if key > probe][:limit]
+
+    assert sorted_key_list.slice(0, len(expected)) == expected
+    assert list(sorted_key_list) == expected
+
+
+def test_sorted_key_list_empty(vote_app):
+    sorted_key_list = vote_app.SortedKeyList()
+    assert len(sorted_key_list) == 0
+    assert sorted_key_list.slice(0, 10) == []
+    assert sorted_key_list.index((0, 0)) == 0
+    assert sorted_key_list.after((0, 0), 10) == []
+
+
+def sql_ranking(vote_app):
+    # DB上で (投票数の降順, weapon_id の昇順) に並べた有効なキット
+    votes = vote_app.Votes
+    with vote_app.app.app_context():
+        rows = (
+            vote_app.db.session.query(votes.weapon_id, votes.vote_count)
+            .filter(votes.weapon_id.notin_(vote_app.excluded_kit_ids))
+            .order_by(votes.vote_count.desc(), votes.weapon_id.asc())
+            .all()
+        )
+    return [(row[0], row[1]) for row in rows]
+
+
+def walk_ranking(client, max_rows):
+    # /api/ranking_data を after=<投票数>:<weapon_id> のカーソルで最後までたどる
+    rows = []
+    query = ''
+    while len(rows) <= max_rows:
+        response = client.get('/api/ranking_data' + query)
+        assert response.status_code == 200
+        page = response.get_json()
+        if not page:
+            return rows
+        rows.extend((entry['id'], entry['vote_count']) for entry in page)
+        query = f"?after={page[-1]['vote_count']}:{page[-1]['id']}"
+    pytest.fail('The cursor did not advance')
+
+
+@pytest.mark.parametrize('ranking_mode', ['memory', 'sql'])
+def test_keyset_paging_matches_sql_order(vote_app, monkeypatch, ranking_mode):
+    if ranking_mode == 'sql':
+        monkeypatch.setattr(vote_app, 'ranking_engine', None)
+    else:
+        with vote_app.app.app_context():
+            vote_app.ranking_engine.refresh()
+    vote_app.response_cache.bump_generation()
+
+    expected = sql_ranking(vote_app)
+    assert walk_ranking(vote_app.app.test_client(), len(expected)) == expected
+    assert len(expected) == len(vote_app.valid_kit_ids)
+
+
+@pytest.mark.parametrize('sort_order', ['votes_desc', 'votes_asc'])
+@pytest.mark.parametrize('filters', [('all', 'all', 'all'), ('シューター', 'all', 'all'), ('all', 'トラップ', 'カニタンク')])
+def test_grid_vote_sort_from_ranking_matches_sorted(vote_app, sort_order, filters):
+    # 投票数順はメモリ上のランキングから切り出す。同数は weapon_id の昇順
+    with vote_app.app.app_context():
+        vote_app.ranking_engine.refresh()
+        votes = vote_app.fetch_vote_counts()
+        kit_ids = vote_app.filter_kit_ids(*filters)
+        expected = sorted(kit_ids, key=lambda i: votes[i], reverse=(sort_order == 'votes_desc'))
+        assert expected
+        for start in sorted({0, 100, len(expected) // 2, max(0, len(expected) - 50)}):
+            rows, total = vote_app.grid_page_from_index(*filters, sort_order, start, start + 100)
+            assert total == len(expected)
+            assert rows == [(i, votes[i]) for i in expected[start:start + 100]]
+
+
+def test_votes_applied_during_refresh_are_kept(vote_app, monkeypatch):
+    engine = vote_app.RankingEngine(ttl=60)
+    weapon_id = vote_app.valid_kit_ids[0]
+    with vote_app.app.app_context():
+        engine.refresh()
+        count = engine.counts[weapon_id]
+        fetch_vote_counts = vote_app.fetch_vote_counts
+
+        def fetch_with_vote(*args):
+            # DBを読み終えた後、入れ替える前に他のリクエストの票が反映される
+            result = fetch_vote_counts(*args)
+            engine.apply({weapon_id: count + 5})
+            return result
+
+        monkeypatch.setattr(vote_app, 'fetch_vote_counts', fetch_with_vote)
+        engine.refresh()
+    assert engine.counts[weapon_id] == count + 5
+    assert (weapon_id, count + 5) in engine.page(0, len(engine.counts))
+    # 古い値が後から届いても戻らない
+    engine.apply({weapon_id: count + 1})
+    assert engine.counts[weapon_id] == count + 5
+
+
+def test_stale_ranking_is_refreshed_once(vote_app, monkeypatch):
+    engine = vote_app.RankingEngine(ttl=60)
+    with vote_app.app.app_context():
+        engine.refresh()
+    engine.loaded_at -= 120
+
+    calls = []
+    started = threading.Event()
+    release = threading.Event()
+    fetch_vote_counts = vote_app.fetch_vote_counts
+
+    def slow_fetch(*args):
+        calls.append(args)
+        started.set()
+        release.wait(5)
+        return fetch_vote_counts(*args)
+
+    monkeypatch.setattr(vote_app, 'fetch_vote_counts', slow_fetch)
+
+    def read():
+        with vote_app.app.app_context():
+            engine.page(0, 10)
+
+    first = threading.Thread(target=read)
+    first.start()
+    assert started.wait(5)
+    # 読み直しの間に来たリクエストは待たずに古い構造で応答する
+    others = [threading.Thread(target=read) for _ in range(4)]
+    for thread in others:
+        thread.start()
+    for thread in others:
+        thread.join(5)
+        assert not thread.is_alive()
+    release.set()
+    first.join(5)
+    assert len(calls) == 1
+    assert not engine.is_stale()
@@ -0,0 +1,115 @@
+# /vote/batch (まとめて投票) の入力チェックと回数の上限のテスト
+import pytest
+
+
+@pytest.fixture
+def client(vote_app):
+    return vote_app.app.test_client()
+
+
+@pytest.fixture
+def kit_ids(vote_app):
+    return vote_app.valid_kit_ids[40:43]
+
+
+def current_counts(vote_app, weapon_ids):
+    with vote_app.app.app_context():
+        return vote_app.fetch_vote_counts(weapon_ids)
+
+
+def post_batch(client, body, ip='198.51.100.1'):
+    return client.post('/vote/batch', json=body, headers={'X-Forwarded-For': ip})
+
+
+def test_batch_adds_votes_in_one_request(vote_app, client, kit_ids):
+    first, second, _ = kit_ids
+    before = current_counts(vote_app, [first, second])
+    response = post_batch(client, {'votes': [
+        {'weapon_id': first, 'n': 2}, {'weapon_id': second}, {'weapon_id': first},
+    ]})
+    assert response.status_code == 200
+    # 同じキットへの票はまとめて加算する
+    expected = {first: before[first] + 3, second: before[second] + 1}
+    assert response.get_json()['new_vote_counts'] == {str(k): v for k, v in expected.items()}
+    assert current_counts(vote_app, [first, second]) == expected
+
+
+@pytest.mark.parametrize('body, status', [
+    (None, 400),
+    ({}, 400),
+    ({'votes': []}, 400),
+    ({'votes': {'weapon_id': 0}}, 400),
+    ({'votes': [5]}, 400),
+    ({'votes': [{'weapon_id': 'x'}]}, 404),
+    ({'votes': [{'weapon_id': True}]}, 404),
+    ({'votes': [{'weapon_id': 10 ** 6}]}, 404),
+    ({'votes': [{'n': 1}]}, 404),
+    ({'votes': [{'weapon_id': 'valid', 'n': 0}]}, 400),
+    ({'votes': [{'weapon_id': 'valid', 'n': -1}]}, 400),
+    ({'votes': [{'weapon_id': 'valid', 'n': '2'}]}, 400),
+    ({'votes': [{'weapon_id': 'valid', 'n': 1.5}]}, 400),
+    ({'votes': [{'weapon_id': 'valid', 'n': 1}, {'weapon_id': 'excluded'}]}, 404),
+    ({'votes': [{'weapon_id': 'valid', 'n': 'limit'}]}, 429),
+])
+def test_invalid_batches_are_rejected_without_votes(vote_app, client, kit_ids, body, status):
+    valid_id = kit_ids[0]
+    replacements = {'valid': valid_id, 'excluded': vote_app.excluded_kit_ids[0],
+                    'limit': vote_app.app.config['MAX_VOTES_PER_DAY'] + 1}
+    for entry in (body or {}).get('votes') or []:
+        if isinstance(entry, dict):
+            for key, value in entry.items():
+                if isinstance(value, str) and value in replacements:
+                    entry[key] = replacements[value]
+
+    before = current_counts(vote_app, [valid_id])
+    response = post_batch(client, body)
+    assert response.status_code == status
+    assert response.get_json()['success'] is False
+    # 一部だけ加算されることはない
+    assert current_counts(vote_app, [valid_id]) == before
+
+
+@pytest.fixture
+def vote_quota(vote_app, monkeypatch):
+    # 投票を直接書き込む設定と同じく、回数の加算を票と同じトランザクションでコミットする
+    quota = vote_app.DailyVoteQuota(5, 100, 0, 9, defer_commit=vote_app.app.config['VOTE_WRITE_MODE'] == 'direct')
+    monkeypatch.setattr(vote_app, 'vote_quota', quota)
+    return quota
+
+
+def used_votes(vote_app, quota, ip):
+    with vote_app.app.app_context():
+        return vote_app.db.session.query(vote_app.VoteQuota.vote_count) \
+            .filter_by(client_key=quota.client_key(ip), day=quota.today()).scalar()
+
+
+def test_batch_over_remaining_quota_is_rejected(vote_app, client, kit_ids, vote_quota):
+    first, second, _ = kit_ids
+    ip = '198.51.100.10'
+    response = post_batch(client, {'votes': [{'weapon_id': first, 'n': 3}, {'weapon_id': second}]}, ip)
+    assert response.status_code == 200
+    assert response.get_json()['remaining_votes'] == 1
+
+    before = current_counts(vote_app, [first, second])
+    response = post_batch(client, {'votes': [{'weapon_id': first}, {'weapon_id': second}]}, ip)
+    assert response.status_code == 429
+    assert response.get_json()['remaining_votes'] == 1
+    assert current_counts(vote_app, [first, second]) == before
+    assert used_votes(vote_app, vote_quota, ip) == 4
+
+
+def test_failed_batch_does_not_use_quota(vote_app, client, kit_ids, vote_quota, monkeypatch):
+    ip = '198.51.100.11'
+
+    def fail(increments):
+        raise RuntimeError('write failed')
+
+    with monkeypatch.context() as patch:
+        patch.setattr(vote_app, 'record_votes', fail)
+        response = post_batch(client, {'votes': [{'weapon_id': kit_ids[0], 'n': 2}]}, ip)
+    assert response.status_code == 500
+    # 書き込みに失敗した票の分は数えない (ロールバックまたは払い戻し)
+    assert not used_votes(vote_app, vote_quota, ip)
+    response = post_batch(client, {'votes': [{'weapon_id': kit_ids[0], 'n': 5}]}, ip)
+    assert response.status_code == 200
+    assert response.get_json()['remaining_votes'] == 0
@@ -0,0 +1,117 @@
+# VoteBuffer (まとめて書き込む投票バッファ) とジャーナルの再生のテスト
+import threading
+import time
+
+import pytest
+
+
+@pytest.fixture
+def app_context(vote_app):
+    with vote_app.app.app_context():
+        yield
+
+
+def crash(buffer):
+    # 書き込まずにプロセスが落ちたとみなし、ジャーナルとロックだけを手放す
+    # (書き込み中のスレッドが使っている接続を閉じないように、書き込みが終わるのを待つ)
+    with buffer.flush_lock, buffer.lock:
+        buffer.journal.close()
+        buffer.journal_lock.close()
+
+
+def wait_for_counts(vote_app, expected, timeout=5):
+    deadline = time.monotonic() + timeout
+    while True:
+        vote_app.db.session.rollback()
+        counts = vote_app.fetch_vote_counts(expected)
+        if counts == expected or time.monotonic() > deadline:
+            return counts
+        time.sleep(0.05)
+
+
+def test_journal_is_replayed_and_flushed_after_restart(vote_app, app_context, tmp_path):
+    journal_path = str(tmp_path / 'journal.db')
+    before = vote_app.fetch_vote_counts([3])
+    buffer = vote_app.VoteBuffer(3600, 1000, journal_path)
+    buffer.add(3, 2)
+    crash(buffer)
+
+    restarted = vote_app.VoteBuffer(3600, 1000, journal_path)
+    assert dict(restarted.pending) == {3: 2}
+    # 次の投票を待たずに書き込みのスレッドが動いている
+    assert restarted.thread is not None and restarted.thread.is_alive()
+    restarted.wakeup.set()
+    assert wait_for_counts(vote_app, {3: before[3] + 2}) == {3: before[3] + 2}
+
+    # 書き込んだ票はジャーナルから消えているので、もう一度再起動しても再生されない
+    crash(restarted)
+    assert not vote_app.VoteBuffer(3600, 1000, journal_path).pending
+
+
+def test_orphaned_journal_is_adopted_by_fewer_workers(vote_app, app_context, tmp_path):
+    journal_path = str(tmp_path / 'journal.db')
+    before = vote_app.fetch_vote_counts([5, 6])
+    first = vote_app.VoteBuffer(3600, 1000, journal_path)
+    second = vote_app.VoteBuffer(3600, 1000, journal_path)
+    first.add(5, 3)
+    second.add(6, 5)
+    crash(first)
+    crash(second)
+
+    # 1プロセスだけで再起動しても、2つ目のファイルの票も引き継ぐ
+    restarted = vote_app.VoteBuffer(3600, 1000, journal_path)
+    assert dict(restarted.pending) == {5: 3, 6: 5}
+    restarted.wakeup.set()
+    expected = {5: before[5] + 3, 6: before[6] + 5}
+    assert wait_for_counts(vote_app, expected) == expected
+
+    # 引き継いだファイルは空になっている
+    assert not vote_app.VoteBuffer(3600, 1000, journal_path).pending
+
+
+def test_journal_in_use_is_not_adopted(vote_app, app_context, tmp_path):
+    journal_path = str(tmp_path / 'journal.db')
+    running = vote_app.VoteBuffer(3600, 1000, journal_path)
+    running.add(7, 1)
+
+    # 動いているプロセスのファイルはロックされているので、新しいプロセスは別のファイルを使う
+    started = vote_app.VoteBuffer(3600, 1000, journal_path)
+    assert not started.pending
+    assert dict(running.pending) == {7: 1}
+    running.flush()
+
+
+def test_add_returns_projected_counts(vote_app, app_context, monkeypatch):
+    weapon_id = vote_app.valid_kit_ids[30]
+    before = vote_app.fetch_vote_counts([weapon_id])[weapon_id]
+    buffer = vote_app.VoteBuffer(3600, 1000)
+    assert buffer.add(weapon_id) == before + 1
+    assert buffer.add(weapon_id, 2) == before + 3
+    assert vote_app.fetch_vote_counts([weapon_id]) == {weapon_id: before}
+
+    started = threading.Event()
+    release = threading.Event()
+    apply_vote_increments = vote_app.apply_vote_increments
+
+    def slow_apply(increments):
+        started.set()
+        release.wait(5)
+        return apply_vote_increments(increments)
+
+    monkeypatch.setattr(vote_app, 'apply_vote_increments', slow_apply)
+    flusher = threading.Thread(target=buffer.flush)
+    flusher.start()
+    assert started.wait(5)
+    # 書き込み中の票も予想される投票数に含める
+    assert buffer.add(weapon_id) == before + 4
+    # 他のインスタンスの票が先にDBへ入る
+    apply_vote_increments({weapon_id: 10})
+    release.set()
+    flusher.join(5)
+    assert not flusher.is_alive()
+
+    # 書き込み後はDB上の値 (他のインスタンスの票を含む) に積み残しを足した値になる
+    assert vote_app.fetch_vote_counts([weapon_id]) == {weapon_id: before + 13}
+    assert buffer.add(weapon_id) == before + 15
+    buffer.flush()
+    assert vote_app.fetch_vote_counts([weapon_id]) == {weapon_id: before + 15}
@@ -0,0 +1,75 @@
+# 投票数の加算とシャード方式の集約 (compact_vote_shards) のテスト
+import pytest
+from sqlalchemy import event
+
+
+@pytest.fixture
+def sharded(vote_app, monkeypatch):
+    # VOTE_STORAGE は呼び出し時に参照されるので、設定だけを切り替えて関数を直接呼ぶ
+    monkeypatch.setitem(vote_app.app.config, 'VOTE_STORAGE', 'sharded')
+    with vote_app.app.app_context():
+        vote_app.compact_vote_shards()
+        yield
+        # 次のテストに未集約の票を残さない
+        vote_app.compact_vote_shards()
+
+
+def stored_counts(vote_app, weapon_id):
+    # (votes の値, シャードの合計) を返す
+    votes = vote_app.db.session.get(vote_app.Votes, weapon_id).vote_count
+    shards = vote_app.db.session.query(vote_app.db.func.sum(vote_app.VoteShards.vote_count)) \
+        .filter_by(weapon_id=weapon_id).scalar() or 0
+    vote_app.db.session.rollback()
+    return votes, shards
+
+
+def test_single_increments_return_new_counts(vote_app):
+    first, second = vote_app.valid_kit_ids[10:12]
+    with vote_app.app.app_context():
+        before = vote_app.fetch_vote_counts([first, second])
+        new_counts = vote_app.apply_vote_increments({first: 2, second: 1, 10 ** 6: 1})
+        # 存在しないIDは結果に含まれない
+        assert new_counts == {first: before[first] + 2, second: before[second] + 1}
+        assert vote_app.fetch_vote_counts([first, second]) == new_counts
+
+
+def test_sharded_increments_are_summed_with_votes(vote_app, sharded):
+    weapon_id = vote_app.valid_kit_ids[20]
+    votes_before, _ = stored_counts(vote_app, weapon_id)
+    for _ in range(5):
+        new_counts = vote_app.apply_vote_increments({weapon_id: 2})
+    assert new_counts == {weapon_id: votes_before + 10}
+    # votes の行には触れず、シャードに加算している
+    assert stored_counts(vote_app, weapon_id) == (votes_before, 10)
+
+    assert vote_app.compact_vote_shards() == 10
+    assert stored_counts(vote_app, weapon_id) == (votes_before + 10, 0)
+    assert not vote_app.VoteShards.query.filter_by(weapon_id=weapon_id).count()
+    assert vote_app.fetch_vote_counts([weapon_id]) == {weapon_id: votes_before + 10}
+
+
+def test_compaction_keeps_votes_added_after_the_read(vote_app, sharded):
+    weapon_id = vote_app.valid_kit_ids[21]
+    votes_before, _ = stored_counts(vote_app, weapon_id)
+    vote_app.apply_vote_increments({weapon_id: 4})
+    engine = vote_app.db.engine
+    injected = []
+
+    def vote_after_read(conn, cursor, statement, parameters, context, executemany):
+        # シャードを読み取った直後、差し引く前に他のリクエストの票が入る
+        if not injected and statement.lstrip().startswith('SELECT') and 'FROM vote_shards' in statement:
+            injected.append(statement)
+            cursor.connection.execute(
+                "UPDATE vote_shards SET vote_count = vote_count + 3 WHERE weapon_id = ?", (weapon_id,)
+            )
+
+    event.listen(engine, 'after_cursor_execute', vote_after_read)
+    try:
+        assert vote_app.compact_vote_shards() == 4
+    finally:
+        event.remove(engine, 'after_cursor_execute', vote_after_read)
+    assert injected
+
+    # 読み取った4票だけが votes に移り、後から入った3票はシャードに残る
+    assert stored_counts(vote_app, weapon_id) == (votes_before + 4, 3)
+    assert vote_app.fetch_vote_counts([weapon_id]) == {weapon_id: votes_before + 7}